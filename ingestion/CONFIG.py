@@ -1,7 +1,12 @@
-# from translators import DeepL
-# PreferredTranslator = DeepL()
+# Remote translators are worth wrapping in the persistent cache (see translators.py)
+# from translators import CachedTranslator, DeepL
+# PreferredTranslator = CachedTranslator(DeepL())
 from translators import DummyTranslator
 PreferredTranslator = DummyTranslator()
 
+# from interfaces import SegmentFiles
+# PreferredInterface = SegmentFiles()
+# from interfaces import SqliteInterface
+# PreferredInterface = SqliteInterface()
 from interfaces import MongoInterface
 PreferredInterface = MongoInterface('mongodb://localhost:27017/')
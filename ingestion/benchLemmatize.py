@@ -0,0 +1,42 @@
+'''
+Benchmark lemmatization throughput in sentences/sec:
+one nlp() call per sentence (the old path) against lemmatizeBatch.
+Run with: python benchLemmatize.py [--sentences 2000]
+'''
+
+import argparse
+import time
+
+from lemmatizer import lemmatize, lemmatizeBatch
+
+SENTENCES = [
+    'O menino que sobreviveu morava com os tios numa casa da rua dos Alfeneiros.',
+    'Ninguém poderia imaginar que ali aconteceria alguma coisa estranha ou misteriosa.',
+    'Era o tipo de gente que não aprovava esse tipo de bobagem.',
+    'Ele olhou pela janela e viu uma coruja voando sobre o jardim à luz do dia.',
+    'As cartas chegaram de manhã, escritas com tinta verde num pergaminho amarelado.',
+]
+
+parser = argparse.ArgumentParser(description='Benchmark lemmatization throughput')
+parser.add_argument('--sentences', type=int, default=2000, help='Number of sentences to lemmatize')
+parser.add_argument('--processes', type=int, default=1, help='n_process for the batched runs')
+
+def throughput(func, count):
+    start = time.perf_counter()
+    func()
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    texts = [SENTENCES[i % len(SENTENCES)] for i in range(args.sentences)]
+
+    perSentence = throughput(lambda: [lemmatize(text) for text in texts], len(texts))
+    print(f"nlp() per sentence: {perSentence:8.1f} sentences/sec")
+
+    for batchSize in [16, 64, 256]:
+        batched = throughput(
+            lambda: lemmatizeBatch(texts, batch_size=batchSize, n_process=args.processes),
+            len(texts),
+        )
+        print(f"nlp.pipe batch_size={batchSize:<4}: {batched:8.1f} sentences/sec ({batched / perSentence:.1f}x)")
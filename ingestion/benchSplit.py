@@ -0,0 +1,96 @@
+'''
+Regression benchmark for split_sentences on a pathological input:
+a long run of lines with no sentence break (poetry, tables, ...).
+Compares against the old splitter that re-tokenized the whole buffer after every line.
+Run with: python benchSplit.py [--lines 10000]
+'''
+
+import argparse
+import time
+from hashlib import sha256
+
+from nltk.tokenize import sent_tokenize
+
+from clean import split_sentences
+
+parser = argparse.ArgumentParser(description='Benchmark split_sentences')
+parser.add_argument('--lines', type=int, default=10_000, help='Number of lines without a period')
+parser.add_argument('--skip-rescan', action='store_true', help='Only time the streaming splitter')
+
+
+def split_sentences_rescan(lines, numbers):
+    '''
+    The previous split_sentences, kept as the reference output.
+    '''
+    def getMostFreq(nums):
+        counts = {}
+        for num in nums:
+            if num not in counts:
+                counts[num] = 0
+            counts[num] += 1
+
+        maxval = max(counts.values())
+        for key, val in counts.items():
+            if val == maxval:
+                return key
+
+    def sentence(text, properPage, pageCount, mediaIndex):
+        return {
+            'id': sha256(text.encode('utf-8')).hexdigest(),
+            'page': properPage,
+            'page_sentence_index': pageCount,
+            'combined_index': f'{properPage}.{pageCount}',
+            'media_index': mediaIndex,
+            'text': text,
+        }
+
+    out = []
+    buffer = ""
+    numBuffer = []
+    pageSentCounts = {}
+    sentenceCounter = 0
+    for line, num in zip(lines, numbers):
+        buffer = (buffer + ' ' + line).strip()
+        numBuffer.append(num)
+        sents = sent_tokenize(buffer, language='portuguese')
+        if len(sents) > 1:
+            for sent in sents[:-1]:
+                properPage = getMostFreq(numBuffer)
+                pageCount = pageSentCounts.get(properPage, 0)
+                pageSentCounts[properPage] = pageCount + 1
+                out.append(sentence(sent, properPage, pageCount, sentenceCounter))
+                sentenceCounter += 1
+            buffer = sents[-1]
+            numBuffer = [numBuffer[-1]]
+
+    properPage = getMostFreq(numBuffer)
+    pageCount = pageSentCounts.get(properPage, 0)
+    out.append(sentence(buffer, properPage, pageCount, sentenceCounter))
+
+    return out
+
+
+def pathological_lines(count):
+    lines = [f'verso número {i} sem ponto final, e segue a estrofe' for i in range(count)]
+    lines.append('E então acabou. Fim do poema.')
+    numbers = [1 + i // 40 for i in range(len(lines))]
+    return lines, numbers
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    lines, numbers = pathological_lines(args.lines)
+
+    streamed, streamTime = timed(lambda: split_sentences(lines, numbers))
+    print(f"streaming split_sentences: {streamTime:8.2f} s for {len(lines)} lines")
+
+    if not args.skip_rescan:
+        rescanned, rescanTime = timed(lambda: split_sentences_rescan(lines, numbers))
+        print(f"full buffer rescan:        {rescanTime:8.2f} s ({rescanTime / streamTime:.1f}x slower)")
+        print(f"identical output: {streamed == rescanned}")
@@ -0,0 +1,87 @@
+'''
+Benchmark translating a document the way ingest.py does, one translate() call per
+chunk, against a stub that sleeps like a remote API: the plain translator one chunk
+at a time (the old path) against CachedTranslator with several chunks translating
+at once, cold (empty cache) and warm (re-ingesting the same document).
+Run with: python benchTranslate.py [--sentences 1000] [--latency 0.2]
+'''
+
+import argparse
+import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from translators import CachedTranslator, LatencyStub
+
+parser = argparse.ArgumentParser(description='Benchmark cached, batched translation')
+parser.add_argument('--sentences', type=int, default=1000, help='Sentences in the document')
+parser.add_argument('--unique', type=int, default=800, help='How many of them are distinct')
+parser.add_argument('--chunk', type=int, default=50, help='Ingest chunk size (processDocs.py --size)')
+parser.add_argument('--translators', type=int, default=4, help='Chunks translating at once (processDocs.py --translators)')
+parser.add_argument('--latency', type=float, default=0.2, help='Seconds per translator call')
+parser.add_argument('--per-sentence', type=float, default=0.005, help='Extra seconds per sentence in a call')
+parser.add_argument('--batch-size', type=int, default=50, help='CachedTranslator batchSize')
+parser.add_argument('--concurrency', type=int, default=4, help='CachedTranslator batches in flight')
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+def translateChunks(translator, sents, chunkSize, translators=1):
+    '''
+    Translate chunk by chunk like ingest.ingestAll: up to `translators` chunks at once,
+    collected in order with at most 2 * translators of them pending.
+    '''
+    out = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=translators) as pool:
+        for i in range(0, len(sents), chunkSize):
+            pending.append(pool.submit(translator.translate, sents[i:i+chunkSize]))
+            if len(pending) >= 2 * translators:
+                out.extend(pending.popleft().result())
+
+        while pending:
+            out.extend(pending.popleft().result())
+
+    return out
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sents = [f'Frase número {i % args.unique} do livro.' for i in range(args.sentences)]
+
+    stub = LatencyStub(latency=args.latency, perSentence=args.per_sentence)
+    oldTime, expected = timed(lambda: translateChunks(stub, sents, args.chunk))
+    print(f"per chunk, uncached, 1 at a time:  {oldTime:7.2f} s ({stub.calls} calls)")
+
+    with tempfile.TemporaryDirectory() as directory:
+        def cachedTranslator(name):
+            stub = LatencyStub(latency=args.latency, perSentence=args.per_sentence)
+            return stub, CachedTranslator(
+                stub,
+                path=os.path.join(directory, f'{name}.sqlite'),
+                batchSize=args.batch_size,
+                concurrency=args.concurrency,
+            )
+
+        # With one chunk at a time and a chunk no bigger than a batch, nothing overlaps
+        stub, cached = cachedTranslator('serial')
+        serialTime, serial = timed(lambda: translateChunks(cached, sents, args.chunk))
+        print(f"cached, cold, 1 at a time:         {serialTime:7.2f} s ({stub.calls} calls, "
+              f"{stub.peakInFlight} in flight, {oldTime / serialTime:.1f}x faster)")
+
+        stub, cached = cachedTranslator('overlapped')
+        coldTime, cold = timed(lambda: translateChunks(cached, sents, args.chunk, args.translators))
+        print(f"cached, cold, {args.translators} at a time:         {coldTime:7.2f} s ({stub.calls} calls, "
+              f"{stub.peakInFlight} in flight, {oldTime / coldTime:.1f}x faster)")
+
+        stub.calls = 0
+        warmTime, warm = timed(lambda: translateChunks(cached, sents, args.chunk, args.translators))
+        print(f"cached, warm, {args.translators} at a time:         {warmTime:7.2f} s ({stub.calls} calls, "
+              f"{oldTime / warmTime:.0f}x faster)")
+
+        print(f"identical output: {serial == expected and cold == expected and warm == expected}")
+        print(cached.report())
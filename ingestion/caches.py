@@ -0,0 +1,117 @@
+'''
+Caches shared by the ingestion steps: a bounded in-memory LRU and a
+SQLite-backed key/value store that keeps results between runs.
+'''
+
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+
+class LRUCache:
+    '''
+    Dict with a maximum size that evicts the least recently used key.
+    '''
+    def __init__(self, maxSize=100_000):
+        self.maxSize = maxSize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def set(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxSize:
+            self.items.popitem(last=False)
+
+
+class SqliteStore:
+    '''
+    Persistent key -> JSON value table. Several processes can share the file.
+    Writes are buffered until flush() (or until flushEvery of them are pending).
+    '''
+    def __init__(self, path, table, flushEvery=500):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.table = table
+        self.flushEvery = flushEvery
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+        )
+        self.connection.commit()
+
+    def get(self, key, default=None):
+        return self.getMany([key]).get(key, default)
+
+    def getMany(self, keys):
+        '''
+        Returns {key: value} for the keys that are stored.
+        '''
+        found = {}
+        with self.lock:
+            missing = []
+            for key in keys:
+                if key in self.pending:
+                    found[key] = self.pending[key]
+                else:
+                    missing.append(key)
+
+            # Stay under SQLite's bound parameter limit
+            for i in range(0, len(missing), 500):
+                batch = missing[i:i+500]
+                placeholders = ', '.join('?' * len(batch))
+                rows = self.connection.execute(
+                    f'SELECT key, value FROM {self.table} WHERE key IN ({placeholders})',
+                    batch,
+                )
+                for key, value in rows:
+                    found[key] = json.loads(value)
+
+        return found
+
+    def set(self, key, value):
+        self.setMany({key: value})
+
+    def setMany(self, items):
+        with self.lock:
+            self.pending.update(items)
+            shouldFlush = len(self.pending) >= self.flushEvery
+
+        if shouldFlush:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+
+            self.connection.executemany(
+                f'INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)',
+                [(key, json.dumps(value)) for key, value in self.pending.items()],
+            )
+            self.connection.commit()
+            self.pending = {}
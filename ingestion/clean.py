@@ -36,63 +36,96 @@ def process_lines(lines):
     return cleaned, pageNum
 
 
-def split_sentences(lines, numbers):
-    def getMostFreq(nums):
-        counts = {}
-        for num in nums:
-            if num not in counts:
-                counts[num] = 0
-            counts[num] += 1
-
-        maxval = max(counts.values())
-        for key, val in counts.items():
-            if val == maxval:
-                return key
-
-        if nums[0]:
-            return nums[0]
-        else:
-            return '-1'
+# Sentence breaks are decided from a token, the punctuation after it and the next token.
+# So when a line is added to a buffer that holds a single sentence, a new break can only
+# show up around the join or inside the new line, and only that tail is re-tokenized.
+TAIL_CONTEXT_CHARS = 200
 
 
-    out = []
-    buffer = ""
-    numBuffer = []
+def make_sentence(text, pageCounts, pageSentCounts, mediaIndex):
+    properPage = most_freq_page(pageCounts)
+    pageCount = pageSentCounts.get(properPage, 0)
+    pageSentCounts[properPage] = pageCount + 1
+    return {
+        'id': sha256(text.encode('utf-8')).hexdigest(),
+        'page': properPage,
+        'page_sentence_index': pageCount,
+        'combined_index': f'{properPage}.{pageCount}',
+        'media_index': mediaIndex,
+        'text': text,
+    }
+
+
+def most_freq_page(pageCounts):
+    '''
+    The page with the most lines in the buffer (the earliest one on ties).
+    pageCounts is kept in the order pages were first seen.
+    '''
+    maxval = max(pageCounts.values())
+    for key, val in pageCounts.items():
+        if val == maxval:
+            return key
+
+
+def tail_start(parts, end):
+    '''
+    Index of the first buffered line in the last TAIL_CONTEXT_CHARS or so of parts[:end].
+    Lines are joined with spaces, so a tail made of whole lines starts on a token boundary.
+    Takes the end index instead of a slice, so the buffer is never copied.
+    '''
+    start = end
+    length = 0
+    while start > 0 and length < TAIL_CONTEXT_CHARS:
+        start -= 1
+        length += len(parts[start]) + 1
+    return start
+
+
+def iter_sentences(pairs):
+    '''
+    Stream sentences out of (line, page number) pairs.
+    Gives the same output as tokenizing the whole buffer after every line,
+    but while the buffer holds one sentence only its tail is re-tokenized.
+    '''
+    parts = []
+    pageCounts = {}
     pageSentCounts = {}
     sentenceCounter = 0
-    for line, num in zip(lines, numbers):
-        buffer = (buffer + ' ' + line).strip()
-        numBuffer.append(num)
-        sents = sent_tokenize(buffer, language='portuguese')
+    # Whether the buffer is known to tokenize as a single sentence on its own
+    verified = True
+    for line, num in pairs:
+        pageCounts[num] = pageCounts.get(num, 0) + 1
+
+        # Same as buffer = (buffer + ' ' + line).strip()
+        piece = line.rstrip()
+        if not parts:
+            piece = piece.lstrip()
+        if piece:
+            parts.append(piece)
+        elif verified:
+            continue
+
+        if verified:
+            start = tail_start(parts, len(parts) - 1)
+            if start > 0:
+                window = ' '.join(parts[start:])
+                if len(sent_tokenize(window, language='portuguese')) < 2:
+                    continue
+
+        sents = sent_tokenize(' '.join(parts), language='portuguese')
         if len(sents) > 1:
             for sent in sents[:-1]:
-                properPage = getMostFreq(numBuffer)
-                pageCount = pageSentCounts.get(properPage, 0)
-                pageSentCounts[properPage] = pageCount + 1
-                out.append({
-                    'id': sha256(sent.encode('utf-8')).hexdigest(),
-                    'page': properPage,
-                    'page_sentence_index': pageCount,
-                    'combined_index': f'{properPage}.{pageCount}',
-                    'media_index': sentenceCounter,
-                    'text': sent,
-                })
+                yield make_sentence(sent, pageCounts, pageSentCounts, sentenceCounter)
                 sentenceCounter += 1
-            buffer = sents[-1]
-            numBuffer = [numBuffer[-1]]
+            parts = [sents[-1]]
+            pageCounts = {num: 1}
+            verified = False
+        else:
+            verified = True
 
-    # TODO: Having this extra iteration outside the loop is a STRONG code smell.
     # Get the last sentence from leftover buffers
-    properPage = getMostFreq(numBuffer)
-    pageCount = pageSentCounts.get(properPage, 0)
-    pageSentCounts[properPage] = pageCount + 1
-    out.append({
-        'id': sha256(buffer.encode('utf-8')).hexdigest(),
-        'page': getMostFreq(numBuffer),
-        'page_sentence_index': pageCount,
-        'combined_index': f'{properPage}.{pageCount}',
-        'media_index': sentenceCounter,
-        'text': buffer,
-    })
+    yield make_sentence(' '.join(parts), pageCounts, pageSentCounts, sentenceCounter)
+
 
-    return out
\ No newline at end of file
+def split_sentences(lines, numbers):
+    return list(iter_sentences(zip(lines, numbers)))
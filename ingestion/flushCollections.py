@@ -3,6 +3,7 @@ import pymongo
 client = pymongo.MongoClient('mongodb://localhost:27017/')
 
 client['language']['vocab'].drop()
+client['language']['vocab_due'].drop()
 client['language']['snippets'].drop()
 client['language']['samples'].drop()
 
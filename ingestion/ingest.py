@@ -1,91 +1,32 @@
 import time
-import math
-import re
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-import wordfreq
-import spacy
-nlp = spacy.load('pt_core_news_sm')
-from nltk.corpus import wordnet as wn
+from lemmatizer import LEXICON, lemmatizeChunk, lemmatizeChunkJob
 
 from CONFIG import PreferredTranslator as Translator
 from CONFIG import PreferredInterface as Interface
 
-WORD_FREQ_FILTER_THRESHOLD = 7.0
 
-def realWord(text):
-    # Check that a string isn't just punctuation
-    return re.match(r'[^\w\s]', text) == None
-
-
-def lemmatize(text, parentSnippet=None):
+def prepChunk(items, chunkString='', lemmatized=None, translations=None):
     '''
-    Default lemmatize function, using spacy.
+    Lemmatize and translate a chunk of snippets.
+    Pass lemmatized (a lemmatizeChunk result) and translations when they already
+    ran in a pipeline stage.
     '''
-    doc = nlp(text)
-    result = {}
-    seenLemmas = set()
-    for i, word in enumerate(doc):
-        lemma = word.lemma_
-        freq = wordfreq.zipf_frequency(lemma, 'pt')
-
-        if realWord(lemma) and lemma not in seenLemmas:
-            seenLemmas.add(lemma)
-
-            synsets = wn.synsets(lemma, lang='por')
-            synValues = [(s.name(), s.definition()) for s in synsets]
-            specificID =f"{lemma} - {word.pos_} - {i} - {parentSnippet}"
-
-            # Filter to ignore super common words (the, a, of, etc.)
-            if freq > WORD_FREQ_FILTER_THRESHOLD:
-                continue
-
-            m = {}
-            m['text'] = word.text
-            m['lemma'] = lemma
-            m['pos'] = word.pos_
-            m['word_freq'] = freq
-            m['sentence_order_position'] = i
-            m['morph'] = word.morph.to_dict()
-            m['synsets'] = synValues
-            m['head'] = word.head.text
-            m['type'] = 'word'
-            m['vocab_id'] = f"{lemma} - {word.pos_}"
-            m['parent_snippet'] = parentSnippet
-            m['specific_id'] = specificID
-            m['vect'] = word.vector.tolist()
-
-            result[specificID] = m
-
-    texts = []
-    for word in doc:
-        if realWord(word.text):
-            texts.append({
-                'text': word.text,
-                'vocab': f"{word.lemma_} - {word.pos_}"
-            })
-    return result, texts
-
-
-def prepChunk(items, chunkString=''):
     # Pull text from items
     sents = [item['text'] for item in items]
-    ids = [item['id'] for item in items]
 
     # Generate new data
     print(f"Getting translations for chunk: {chunkString}")
 
     try:
-        sampleItemResults = {}
-        lemmaSets = []
-        vocabSets = []
-        textArrs = []
-        for sent, idx in zip(sents, ids):
-            lresult, texts = lemmatize(sent, parentSnippet=idx)
-            textArrs.append(texts)
-            sampleItemResults.update(lresult)
-            lemmaSets.append(list(lresult.keys()))
-            vocabSets.append(list(item['vocab_id'] for item in lresult.values()))
-        translations = Translator.translate(sents)
+        if lemmatized is None:
+            lemmatized = lemmatizeChunk(items)
+        sampleItemResults, lemmaSets, vocabSets, textArrs = lemmatized
+        if translations is None:
+            translations = Translator.translate(sents)
     except Exception as e:
         print(f"Error prepping chunk: {e}")
         # Print full exception for debugging
@@ -111,36 +52,140 @@ def prepChunk(items, chunkString=''):
     return snippetResults, sampleItemResults
 
 
-def ingestAll(items, sourceType, sourcePath, chunkSize=10, chunkDelay=0):
-    allSnippetItems = {}
-    allSampleItems = {}
-    totalChunks = math.ceil(len(items) / chunkSize)
-    for i in range(0, len(items), chunkSize):
-        chunk = items[i:i+chunkSize]
-        chunkIndex = 1 + (i // chunkSize)
+def iterNewChunks(items, chunkSize, counts, manifest=None):
+    '''
+    Group items into chunks of ones that are not stored yet, checking chunkSize ids at a time.
+    An id already seen in this run is dropped too, so the writer never gets a duplicate key.
+    With a manifest, items in its written ranges are skipped without a lookup, and items
+    of chunks that were in flight are redone even if some of their rows were stored.
+    Counts the items seen and kept in counts['items'] and counts['new'].
+    '''
+    seen = set()
+    batch = []
+    newItems = []
+
+    def keepNew(batch):
+        existing = Interface.existingSnippetIds([item['id'] for item in batch])
+        for item in batch:
+            redo = manifest is not None and manifest.isStarted(item['media_index'])
+            if (redo or item['id'] not in existing) and item['id'] not in seen:
+                seen.add(item['id'])
+                newItems.append(item)
+                counts['new'] += 1
+
+    for item in items:
+        counts['items'] += 1
+        if manifest and manifest.isCompleted(item['media_index']):
+            continue
+        batch.append(item)
+        if len(batch) < chunkSize:
+            continue
+
+        keepNew(batch)
+        batch = []
+        while len(newItems) >= chunkSize:
+            yield newItems[:chunkSize]
+            del newItems[:chunkSize]
+
+    if batch:
+        keepNew(batch)
+    for i in range(0, len(newItems), chunkSize):
+        yield newItems[i:i+chunkSize]
+
+
+def lemmatizeChunkLocal(items):
+    # Same result shape as lemmatizeChunkJob; the stats are already in LEXICON
+    return lemmatizeChunk(items), None
+
+
+def ingestAll(chunks, sourceType, sourcePath, chunkDelay=0, workers=1, translateWorkers=1, manifest=None):
+    '''
+    Ingest an iterable of chunks of new items as a pipeline:
+    extract/split (the iterable) -> NLP -> translate -> write.
+    NLP runs in a process pool with workers > 1 (one spacy model per worker) and on
+    one thread otherwise; translation runs on a pool of translateWorkers threads, at the
+    same time as the NLP of the same chunk. A CachedTranslator caps its own requests at its
+    concurrency however many chunks are translating, so translateWorkers only sets how many
+    chunks overlap their cache lookups. At most a few chunks per worker are in flight
+    and every chunk is written as soon as it is done, so memory stays bounded however
+    long the document is. Writes stay on this thread, the interfaces are not thread-safe.
+    With a manifest (see manifest.py), every chunk is recorded when it starts and when
+    it is written, so an interrupted run can resume from there.
+    Returns the number of snippets and samples written.
+    '''
+    depth = 2 * max(workers, translateWorkers)
+    if workers > 1:
+        print(f"Lemmatizing chunks with {workers} worker processes")
+        nlpPool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+        nlpJob = lemmatizeChunkJob
+    else:
+        nlpPool = ThreadPoolExecutor(max_workers=1)
+        nlpJob = lemmatizeChunkLocal
+    translatePool = ThreadPoolExecutor(max_workers=translateWorkers)
+
+    written = {'snippets': 0, 'samples': 0}
+    pending = deque()
+
+    def writeOldest():
+        chunkIndex, chunk, lemmatizeJob, translateJob = pending.popleft()
         try:
-            snippetItems, sampleItems = prepChunk(chunk, chunkString=f"{chunkIndex} / {totalChunks}")
+            lemmatized, lexiconStats = lemmatizeJob.result()
+            if lexiconStats:
+                LEXICON.addStats(lexiconStats)
+            snippetItems, sampleItems = prepChunk(
+                chunk,
+                chunkString=str(chunkIndex),
+                lemmatized=lemmatized,
+                translations=translateJob.result(),
+            )
             for item in snippetItems.values():
                 item['source_type'] = sourceType
                 item['source_path'] = sourcePath
-                allSnippetItems[item['id']] = item
 
-            for item in sampleItems.values():
-                allSampleItems[item['specific_id']] = item
+            Interface.ingestItems(snippetItems, sampleItems)
+            written['snippets'] += len(snippetItems)
+            written['samples'] += len(sampleItems)
+            if manifest:
+                manifest.complete(chunk, len(snippetItems), len(sampleItems))
+
+        except Exception as e:
+            print(f"Error ingesting chunk {chunkIndex}: {e}")
+            print(f"Skipping chunk")
+
+    try:
+        for chunkIndex, chunk in enumerate(chunks, start=1):
+            if manifest:
+                manifest.start(chunk)
+            pending.append((
+                chunkIndex,
+                chunk,
+                nlpPool.submit(nlpJob, chunk),
+                translatePool.submit(Translator.translate, [item['text'] for item in chunk]),
+            ))
+            if len(pending) >= depth:
+                writeOldest()
 
             if chunkDelay:
                 print(f"Sleeping for {chunkDelay} seconds...")
                 time.sleep(chunkDelay)
 
-        except KeyboardInterrupt:
-            print(f"Caught KeyboardInterrupt, stopping ingestion")
-            break
+        while pending:
+            writeOldest()
 
-        except Exception as e:
-            print(f"Error ingesting chunk {chunkIndex} - {totalChunks}: {e}")
-            print(f"Skipping chunk")
+        if manifest:
+            manifest.finish()
+
+    except KeyboardInterrupt:
+        print(f"Caught KeyboardInterrupt, stopping ingestion")
 
-    return allSnippetItems, allSampleItems
+    finally:
+        nlpPool.shutdown(wait=False, cancel_futures=True)
+        translatePool.shutdown(wait=False, cancel_futures=True)
+
+    return written['snippets'], written['samples']
 
 
 def ingestNew(
@@ -148,19 +193,25 @@ def ingestNew(
         sourceType,
         sourcePath,
         chunkSize=10,
-        chunkDelay=0
+        chunkDelay=0,
+        workers=1,
+        translateWorkers=1,
+        manifest=None,
     ):
-    # Load existing entries
-    existingEntries = Interface.existingSnippets()
-
-    # Filter out existing entries
-    newEntries = list(filter(lambda x: x['id'] not in existingEntries, items))
-    print(f"Found {len(newEntries)} / {len(items)} to be new entries")
-
-    # Ingest new entries
-    if newEntries:
-        snippetItems, sampleItems = ingestAll(newEntries, sourceType, sourcePath, chunkSize, chunkDelay)
-        print(f"Ingesting {len(snippetItems)} snippets and {len(sampleItems)} sample items")
-        Interface.ingestItems(snippetItems, sampleItems)
-
-        # Create entries for new vocab
+    '''
+    Ingest the items (any iterable, e.g. a sentence stream) that are not stored yet.
+    '''
+    counts = {'items': 0, 'new': 0}
+    chunks = iterNewChunks(items, chunkSize, counts, manifest)
+    snippetCount, sampleCount = ingestAll(
+        chunks,
+        sourceType,
+        sourcePath,
+        chunkDelay=chunkDelay,
+        workers=workers,
+        translateWorkers=translateWorkers,
+        manifest=manifest,
+    )
+
+    print(f"Found {counts['new']} / {counts['items']} to be new entries")
+    print(f"Ingested {snippetCount} snippets and {sampleCount} sample items")
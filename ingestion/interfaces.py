@@ -4,12 +4,60 @@ Classes should be able to ingest a list of new snippets and sample items,
 as well as return existing entrie ids.
 '''
 
+import base64
 import json
 import os
 from abc import ABC, abstractmethod
 import pymongo
+import pymongo.errors
 from datetime import datetime, timedelta
 
+from langdb.migrations import SQLITE_DEFAULT_PATH, connectSqlite, migrate, migrateSqlite
+
+from segments import SegmentStore
+
+def splitVectors(sampleItems):
+    '''
+    Remove the packed vectors from the samples (modifies them).
+    Returns {vocab_id: vector bytes} with the first vector seen for each vocab item.
+    '''
+    vectors = {}
+    for sample in sampleItems.values():
+        vector = sample.pop('vect', None)
+        if vector is not None:
+            vectors.setdefault(sample['vocab_id'], vector)
+
+    return vectors
+
+def encodeVector(vector):
+    # The JSON stores keep the packed bytes as base64 text
+    return base64.b64encode(vector).decode('ascii')
+
+def vocabDefaults(sample, vector=None):
+    '''
+    Fields of a new vocab item, taken from the first sample seen for it.
+    '''
+    defaults = {
+        'lemma': sample['lemma'],
+        'pos': sample['pos'],
+        'word_freq': sample['word_freq'],
+        'rep_data': {
+            'last_review': None,
+            'last_strength': None,
+            'average_strength': 1,
+            'history_length': 0,
+            'history': [],
+            'next_review': None,
+            'next_review_average': None,
+        },
+        'tags': [],
+    }
+    if vector is not None:
+        defaults['vect'] = vector
+
+    return defaults
+
+
 class BaseInterface(ABC):
     '''
     This class is used to check that all interfaces have the required methods.
@@ -22,6 +70,13 @@ class BaseInterface(ABC):
     def existingSnippets(self):
         pass
 
+    @abstractmethod
+    def existingSnippetIds(self, ids):
+        '''
+        Return the subset of the given snippet ids that are already stored.
+        '''
+        pass
+
     @abstractmethod
     def getSnippets(self, snippets=None):
         pass
@@ -40,9 +95,15 @@ class BaseInterface(ABC):
 
 
 class LocalFiles(BaseInterface):
-    def __init__(self, snippetsPath='./entries/entries.json', samplesPath='./entries/sample.json'):
+    def __init__(
+            self,
+            snippetsPath='./entries/entries.json',
+            samplesPath='./entries/sample.json',
+            vectorsPath='./entries/vectors.json',
+        ):
         self.snippetsPath = snippetsPath
         self.samplesPath = samplesPath
+        self.vectorsPath = vectorsPath
 
         # Check file exists and is not empty
         if not os.path.exists(snippetsPath) or os.path.getsize(snippetsPath) == 0:
@@ -54,6 +115,10 @@ class LocalFiles(BaseInterface):
             with open(samplesPath, 'w') as file:
                 file.write('{}')
 
+        if not os.path.exists(vectorsPath) or os.path.getsize(vectorsPath) == 0:
+            with open(vectorsPath, 'w') as file:
+                file.write('{}')
+
     def flush(self):
         print("FLUSHING THE DATABASE LOCAL FILE")
         with open(self.snippetsPath, 'w') as file:
@@ -62,12 +127,18 @@ class LocalFiles(BaseInterface):
         with open(self.samplesPath, 'w') as file:
             file.write('{}')
 
+        with open(self.vectorsPath, 'w') as file:
+            file.write('{}')
+
     # Handle snippet items
     def existingSnippets(self):
         with open(self.snippetsPath) as file:
             existingEntries = json.load(file)
             return set(existingEntries.keys())
 
+    def existingSnippetIds(self, ids):
+        return set(ids) & self.existingSnippets()
+
     def getSnippets(self, snippets=None):
         if snippets == None:
             snippets = self.existingSnippets()
@@ -90,11 +161,35 @@ class LocalFiles(BaseInterface):
             existingSample = json.load(file)
             return [existingSample[idx] for idx in sample]
 
+    # Handle word vectors
+    def getVectors(self, vocab):
+        '''
+        {vocab_id: packed vector} for the vocab ids that have one.
+        '''
+        with open(self.vectorsPath) as file:
+            existingVectors = json.load(file)
+
+        return {
+            vocabId: base64.b64decode(existingVectors[vocabId])
+            for vocabId in vocab if vocabId in existingVectors
+        }
+
     # Handle new items
     def ingestItems(self, snippetItems, sampleItems):
         '''
         This func assumes that the provided items are new to the collections
         '''
+        # One vector per vocab id, like on the vocab items of the databases
+        vectors = splitVectors(sampleItems)
+        with open(self.vectorsPath) as file:
+            existingVectors = json.load(file)
+
+        for vocabId, vector in vectors.items():
+            existingVectors.setdefault(vocabId, encodeVector(vector))
+
+        with open(self.vectorsPath, 'w') as file:
+            json.dump(existingVectors, file)
+
         # Process snippets
         with open(self.snippetsPath) as file:
             existingEntries = json.load(file)
@@ -114,7 +209,73 @@ class LocalFiles(BaseInterface):
             json.dump(existingSample, file)
 
 
+class SegmentFiles(BaseInterface):
+    '''
+    Offline store like LocalFiles, but new items are appended to segment files
+    instead of rewriting one JSON file per ingest (see segments.py).
+    '''
+    def __init__(self, directory='./entries/segments'):
+        self.directory = directory
+        self.snippets = SegmentStore(os.path.join(directory, 'snippets'))
+        self.samples = SegmentStore(os.path.join(directory, 'samples'))
+        self.vectors = SegmentStore(os.path.join(directory, 'vectors'))
+
+    def flush(self):
+        print("FLUSHING THE SEGMENT FILES")
+        self.snippets.clear()
+        self.samples.clear()
+        self.vectors.clear()
+
+    # Handle snippet items
+    def existingSnippets(self):
+        return set(self.snippets.ids())
+
+    def existingSnippetIds(self, ids):
+        return {idx for idx in ids if idx in self.snippets}
+
+    def getSnippets(self, snippets=None):
+        if snippets == None:
+            snippets = self.snippets.ids()
+
+        return self.snippets.getMany(snippets)
+
+    # Handle sample items
+    def existingSamples(self):
+        return set(self.samples.ids())
+
+    def getSample(self, sample=None):
+        if sample == None:
+            sample = self.samples.ids()
+
+        return self.samples.getMany(sample)
+
+    # Handle word vectors
+    def getVectors(self, vocab):
+        '''
+        {vocab_id: packed vector} for the vocab ids that have one.
+        '''
+        return {
+            record['vocab_id']: base64.b64decode(record['vect'])
+            for record in self.vectors.getMany(vocab)
+        }
+
+    # Handle new items
+    def ingestItems(self, snippetItems, sampleItems):
+        # One vector per vocab id, like on the vocab items of the databases
+        vectors = splitVectors(sampleItems)
+
+        self.snippets.append(snippetItems)
+        self.samples.append(sampleItems)
+        self.vectors.append({
+            vocabId: {'vocab_id': vocabId, 'vect': encodeVector(vector)}
+            for vocabId, vector in vectors.items()
+            if vocabId not in self.vectors
+        })
+
+
 class MongoInterface(BaseInterface):
+    DUPLICATE_KEY_ERROR = 11000
+
     def __init__(self, mongoURI):
         self.mongoURI = mongoURI
         self.client = pymongo.MongoClient(mongoURI)
@@ -125,17 +286,22 @@ class MongoInterface(BaseInterface):
         self.snippetsCollection = self.db['snippets']
         self.sampleCollection = self.db['samples']
         self.vocabCollection = self.db['vocab']
+        # The server's /snippets queue sort key per vocab item (see langdb/migrations.py)
+        self.vocabDueCollection = self.db['vocab_due']
 
         self.SNIPPET_KEY = 'id'
         self.SAMPLE_KEY = 'specific_id'
         self.SAMPLE_VOCAB_POINTER_KEY = 'vocab_id'
         self.VOCAB_KEY = 'id'
 
+        migrate(self.db)
+
     def flush(self):
         print("FLUSHING THE DATABASE MONGO COLLECTIONS")
         self.snippetsCollection.delete_many({})
         self.sampleCollection.delete_many({})
         self.vocabCollection.delete_many({})
+        self.vocabDueCollection.delete_many({})
 
     def existingSnippets(self):
         result = list(self.snippetsCollection.find({}, {self.SNIPPET_KEY: 1, '_id': 0}))
@@ -143,6 +309,23 @@ class MongoInterface(BaseInterface):
 
         return values
 
+    def existingSnippetIds(self, ids, chunkSize=1000):
+        '''
+        The ids that are already stored, checked with one $in query per chunk,
+        served by the unique id index.
+        '''
+        ids = list(ids)
+        found = set()
+        for i in range(0, len(ids), chunkSize):
+            chunk = ids[i:i+chunkSize]
+            result = self.snippetsCollection.find(
+                {self.SNIPPET_KEY: {'$in': chunk}},
+                {self.SNIPPET_KEY: 1, '_id': 0},
+            )
+            found.update(item[self.SNIPPET_KEY] for item in result)
+
+        return found
+
     def getSnippets(self, snippets=None, limit=0):
         if snippets == None:
             snippets = self.existingSnippets()
@@ -176,45 +359,200 @@ class MongoInterface(BaseInterface):
         result = list(self.vocabCollection.find({self.VOCAB_KEY: {'$in': vocab}}, limit=limit))
         return result
 
+    def insertNew(self, collection, docs):
+        '''
+        insert_many that skips the docs already stored (by their unique id index),
+        so a chunk interrupted halfway through its writes can simply be written again.
+        Returns how many docs were inserted.
+        '''
+        docs = list(docs)
+        try:
+            collection.insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error['code'] != self.DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            print(f"Skipped {len(errors)} {collection.name} already stored")
+            return e.details['nInserted']
+
+        return len(docs)
+
     def ingestItems(self, snippetItems, sampleItems):
         print(f"ingesting snippets: {len(snippetItems)} of snippets obj with type {type(snippetItems)}")
-        # Process snippets
-        self.snippetsCollection.insert_many(snippetItems.values())
-
-        # Process samples
-        self.sampleCollection.insert_many(sampleItems.values())
+        # insert_many refuses an empty list, and a chunk can end up with no samples
+        if snippetItems:
+            self.insertNew(self.snippetsCollection, snippetItems.values())
 
-        # Build vocab
-        existingVocab = set(self.existingVocab())
+        # Process samples (their vectors are stored once per vocab item)
+        vectors = splitVectors(sampleItems)
+        if sampleItems:
+            self.insertNew(self.sampleCollection, sampleItems.values())
 
-        # Update vocab
+        # Group the samples by vocab item, then upsert every vocab item in one bulk write
+        vocabSamples = {}
         for sample in sampleItems.values():
-            if sample[self.SAMPLE_VOCAB_POINTER_KEY] not in existingVocab:
-                self.vocabCollection.insert_one({
-                    self.VOCAB_KEY: sample[self.SAMPLE_VOCAB_POINTER_KEY],
-                    'lemma': sample['lemma'],
-                    'pos': sample['pos'],
-                    'word_freq': sample['word_freq'],
-                    'rep_data': {
-                        'last_review': None,
-                        'last_strength': None,
-                        'average_strength': 1,
-                        'history_length': 0,
-                        'history': [],
+            vocabSamples.setdefault(sample[self.SAMPLE_VOCAB_POINTER_KEY], []).append(sample)
+
+        requests = []
+        for vocabId, samples in vocabSamples.items():
+            requests.append(pymongo.UpdateOne(
+                {self.VOCAB_KEY: vocabId},
+                {
+                    '$setOnInsert': vocabDefaults(samples[0], vectors.get(vocabId)),
+                    '$addToSet': {
+                        'parents': {'$each': list(dict.fromkeys(s['parent_snippet'] for s in samples))},
+                        'samples': {'$each': [s[self.SAMPLE_KEY] for s in samples]},
                     },
-                    'tags': [],
-                    'parents': [sample['parent_snippet']],
-                    'samples': [sample[self.SAMPLE_KEY]]
-                })
-
-                existingVocab.add(sample[self.SAMPLE_VOCAB_POINTER_KEY])
-            else:
-                self.vocabCollection.update_one(
-                    {self.VOCAB_KEY: sample[self.SAMPLE_VOCAB_POINTER_KEY]},
-                    {
-                        '$addToSet': {
-                            'parents': sample['parent_snippet'],
-                            'samples': sample[self.SAMPLE_KEY]
-                        }
-                    }
-                )
\ No newline at end of file
+                },
+                upsert=True,
+            ))
+
+        if requests:
+            print(f"Upserting {len(requests)} vocab items")
+            self.vocabCollection.bulk_write(requests, ordered=False)
+
+            # New vocab joins the queue unreviewed, reviewed vocab keeps its due time
+            self.vocabDueCollection.bulk_write([
+                pymongo.UpdateOne(
+                    {self.VOCAB_KEY: vocabId},
+                    {'$setOnInsert': {'word_freq': samples[0]['word_freq'], 'next_review': None}},
+                    upsert=True,
+                )
+                for vocabId, samples in vocabSamples.items()
+            ], ordered=False)
+
+
+class SqliteInterface(BaseInterface):
+    '''
+    Single file database with the same tables and indexes the server's SQLite backend reads.
+    '''
+    def __init__(self, path=None):
+        self.path = path or SQLITE_DEFAULT_PATH
+        self.connection = connectSqlite(self.path)
+        migrateSqlite(self.connection)
+
+        # Stay under SQLite's bound parameter limit
+        self.CHUNK_SIZE = 500
+
+    def flush(self):
+        print("FLUSHING THE DATABASE SQLITE TABLES")
+        with self.connection:
+            self.connection.execute('DELETE FROM snippets')
+            self.connection.execute('DELETE FROM samples')
+            self.connection.execute('DELETE FROM vocab')
+            self.connection.execute('DELETE FROM vocab_due')
+
+    def selectIn(self, table, keyColumn, columns, keys):
+        '''
+        Rows of table whose keyColumn is in keys, one query per chunk of keys.
+        '''
+        keys = list(keys)
+        rows = []
+        for i in range(0, len(keys), self.CHUNK_SIZE):
+            chunk = keys[i:i+self.CHUNK_SIZE]
+            placeholders = ', '.join('?' * len(chunk))
+            rows.extend(self.connection.execute(
+                f'SELECT {columns} FROM {table} WHERE {keyColumn} IN ({placeholders})',
+                chunk,
+            ))
+
+        return rows
+
+    def existingSnippets(self):
+        return [row[0] for row in self.connection.execute('SELECT id FROM snippets')]
+
+    def existingSnippetIds(self, ids):
+        return {row[0] for row in self.selectIn('snippets', 'id', 'id', ids)}
+
+    def getSnippets(self, snippets=None):
+        if snippets == None:
+            rows = self.connection.execute('SELECT doc FROM snippets')
+        else:
+            rows = self.selectIn('snippets', 'id', 'doc', snippets)
+
+        return [json.loads(row[0]) for row in rows]
+
+    def existingSamples(self):
+        return [row[0] for row in self.connection.execute('SELECT specific_id FROM samples')]
+
+    def getSample(self, sample=None):
+        if sample == None:
+            rows = self.connection.execute('SELECT doc FROM samples')
+        else:
+            rows = self.selectIn('samples', 'specific_id', 'doc', sample)
+
+        return [json.loads(row[0]) for row in rows]
+
+    def existingVocab(self):
+        return [row[0] for row in self.connection.execute('SELECT id FROM vocab')]
+
+    def getVocab(self, vocab=None):
+        if vocab == None:
+            rows = self.connection.execute('SELECT doc FROM vocab')
+        else:
+            rows = self.selectIn('vocab', 'id', 'doc', vocab)
+
+        return [json.loads(row[0]) for row in rows]
+
+    def ingestItems(self, snippetItems, sampleItems):
+        print(f"ingesting {len(snippetItems)} snippets and {len(sampleItems)} samples into {self.path}")
+        # Vectors go in the vocab BLOB column, not in the JSON docs
+        vectors = splitVectors(sampleItems)
+
+        # Group the samples by vocab item and merge them into the stored vocab docs
+        vocabSamples = {}
+        for sample in sampleItems.values():
+            vocabSamples.setdefault(sample['vocab_id'], []).append(sample)
+
+        # One transaction for the whole batch. The write lock is taken before the vocab docs
+        # are read, so nothing another process commits in between (e.g. the server) is overwritten.
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+
+            storedVocab = [json.loads(row[0]) for row in self.selectIn('vocab', 'id', 'doc', vocabSamples.keys())]
+            vocabDocs = {doc['id']: doc for doc in storedVocab}
+            for vocabId, samples in vocabSamples.items():
+                if vocabId not in vocabDocs:
+                    vocabDocs[vocabId] = {'id': vocabId, **vocabDefaults(samples[0]), 'parents': [], 'samples': []}
+                doc = vocabDocs[vocabId]
+                doc['parents'] = list(dict.fromkeys(doc['parents'] + [s['parent_snippet'] for s in samples]))
+                doc['samples'] = list(dict.fromkeys(doc['samples'] + [s['specific_id'] for s in samples]))
+
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO snippets (id, source_path, media_index, doc) VALUES (?, ?, ?, ?)',
+                [
+                    (item['id'], item.get('source_path'), item.get('media_index'), json.dumps(item))
+                    for item in snippetItems.values()
+                ],
+            )
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO samples (specific_id, vocab_id, doc) VALUES (?, ?, ?)',
+                [
+                    (item['specific_id'], item['vocab_id'], json.dumps(item))
+                    for item in sampleItems.values()
+                ],
+            )
+            # A stored vocab item keeps the vector it was created with, and its sort columns
+            self.connection.executemany(
+                'INSERT INTO vocab (id, word_freq, next_review, next_review_average, doc, vect)'
+                ' VALUES (?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT (id) DO UPDATE SET'
+                ' doc = excluded.doc,'
+                ' vect = COALESCE(vocab.vect, excluded.vect)',
+                [
+                    (
+                        doc['id'],
+                        doc['word_freq'],
+                        doc['rep_data']['next_review'],
+                        doc['rep_data']['next_review_average'],
+                        json.dumps(doc),
+                        vectors.get(doc['id']),
+                    )
+                    for doc in vocabDocs.values()
+                ],
+            )
+            # New vocab joins the server's /snippets queue unreviewed
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO vocab_due (id, word_freq, next_review) VALUES (?, ?, NULL)',
+                [(doc['id'], doc['word_freq']) for doc in vocabDocs.values()],
+            )
@@ -0,0 +1,124 @@
+import re
+
+import spacy
+nlp = spacy.load('pt_core_news_sm')
+
+from lexicon import Lexicon
+LEXICON = Lexicon()
+
+# The vector encoding is shared with the server
+from langdb.vectors import packVector
+
+WORD_FREQ_FILTER_THRESHOLD = 7.0
+
+# Only lemma, pos, morph, head and the tok2vec vectors are read from the docs,
+# so components that produce nothing else are skipped when batching.
+LEMMATIZE_DISABLED = [name for name in ['ner'] if name in nlp.pipe_names]
+LEMMATIZE_BATCH_SIZE = 64
+LEMMATIZE_PROCESSES = 1
+
+def realWord(text):
+    # Check that a string isn't just punctuation
+    return re.match(r'[^\w\s]', text) == None
+
+
+def lemmatize(text, parentSnippet=None):
+    '''
+    Default lemmatize function, using spacy.
+    '''
+    return lemmatizeDoc(nlp(text), parentSnippet=parentSnippet)
+
+
+def lemmatizeBatch(texts, parentSnippets=None, batch_size=LEMMATIZE_BATCH_SIZE, n_process=LEMMATIZE_PROCESSES):
+    '''
+    Lemmatize many sentences by streaming them through nlp.pipe.
+    Returns the same (result, texts) pair as lemmatize for each sentence, in order.
+    '''
+    if parentSnippets is None:
+        parentSnippets = [None] * len(texts)
+
+    docs = nlp.pipe(texts, batch_size=batch_size, n_process=n_process, disable=LEMMATIZE_DISABLED)
+    return [
+        lemmatizeDoc(doc, parentSnippet=parentSnippet)
+        for doc, parentSnippet in zip(docs, parentSnippets)
+    ]
+
+
+def lemmatizeDoc(doc, parentSnippet=None):
+    '''
+    Build the sample items and word list for one parsed sentence.
+    '''
+    result = {}
+    seenLemmas = set()
+    for i, word in enumerate(doc):
+        lemma = word.lemma_
+
+        if realWord(lemma) and lemma not in seenLemmas:
+            seenLemmas.add(lemma)
+
+            freq, synValues = LEXICON.lookup(lemma)
+            specificID =f"{lemma} - {word.pos_} - {i} - {parentSnippet}"
+
+            # Filter to ignore super common words (the, a, of, etc.)
+            if freq > WORD_FREQ_FILTER_THRESHOLD:
+                continue
+
+            m = {}
+            m['text'] = word.text
+            m['lemma'] = lemma
+            m['pos'] = word.pos_
+            m['word_freq'] = freq
+            m['sentence_order_position'] = i
+            m['morph'] = word.morph.to_dict()
+            m['synsets'] = synValues
+            m['head'] = word.head.text
+            m['type'] = 'word'
+            m['vocab_id'] = f"{lemma} - {word.pos_}"
+            m['parent_snippet'] = parentSnippet
+            m['specific_id'] = specificID
+            # Binary, and moved onto the vocab item by the interface (see splitVectors)
+            m['vect'] = packVector(word.vector)
+
+            result[specificID] = m
+
+    texts = []
+    for word in doc:
+        if realWord(word.text):
+            texts.append({
+                'text': word.text,
+                'vocab': f"{word.lemma_} - {word.pos_}"
+            })
+    return result, texts
+
+
+def lemmatizeChunk(items, batch_size=LEMMATIZE_BATCH_SIZE, n_process=LEMMATIZE_PROCESSES):
+    '''
+    Lemmatize every snippet in a chunk.
+    This is the NLP half of prepChunk, so it can run in a worker process.
+    '''
+    results = lemmatizeBatch(
+        [item['text'] for item in items],
+        parentSnippets=[item['id'] for item in items],
+        batch_size=batch_size,
+        n_process=n_process,
+    )
+
+    sampleItemResults = {}
+    lemmaSets = []
+    vocabSets = []
+    textArrs = []
+    for lresult, texts in results:
+        textArrs.append(texts)
+        sampleItemResults.update(lresult)
+        lemmaSets.append(list(lresult.keys()))
+        vocabSets.append(list(item['vocab_id'] for item in lresult.values()))
+
+    LEXICON.flush()
+    return sampleItemResults, lemmaSets, vocabSets, textArrs
+
+
+def lemmatizeChunkJob(items):
+    '''
+    lemmatizeChunk for a worker process, also handing back the worker's lexicon cache stats.
+    '''
+    return lemmatizeChunk(items), LEXICON.takeStats()
@@ -0,0 +1,77 @@
+'''
+Per-lemma lexical data (word frequency and WordNet synsets).
+The same few thousand lemmas repeat across a corpus, so each one is looked up
+once, kept in an LRU, and persisted under ingestion/cache/ for later runs.
+'''
+
+import os
+
+import wordfreq
+from nltk.corpus import wordnet as wn
+
+from caches import CACHE_DIR, LRUCache, SqliteStore
+
+LEXICON_CACHE_SIZE = 50_000
+LEXICON_CACHE_PATH = os.path.join(CACHE_DIR, 'lexicon.sqlite')
+
+
+class Lexicon:
+    def __init__(self, maxSize=LEXICON_CACHE_SIZE, path=LEXICON_CACHE_PATH, language='pt', wordnetLanguage='por'):
+        self.language = language
+        self.wordnetLanguage = wordnetLanguage
+        self.memory = LRUCache(maxSize)
+        self.store = SqliteStore(path, 'lexicon') if path else None
+
+        # Lookups answered by the memory cache, the on-disk store, or neither
+        self.stats = {'memory': 0, 'disk': 0, 'computed': 0}
+
+    def lookup(self, lemma):
+        '''
+        Returns (zipf frequency, [(synset name, definition), ...]) for a lemma.
+        '''
+        entry = self.memory.get(lemma)
+        if entry is not None:
+            self.stats['memory'] += 1
+        else:
+            entry = self.store.get(lemma) if self.store else None
+            if entry is not None:
+                self.stats['disk'] += 1
+            else:
+                self.stats['computed'] += 1
+                synsets = wn.synsets(lemma, lang=self.wordnetLanguage)
+                entry = {
+                    'freq': wordfreq.zipf_frequency(lemma, self.language),
+                    'synsets': [(s.name(), s.definition()) for s in synsets],
+                }
+                if self.store:
+                    self.store.set(lemma, entry)
+            self.memory.set(lemma, entry)
+
+        return entry['freq'], [tuple(synset) for synset in entry['synsets']]
+
+    def flush(self):
+        if self.store:
+            self.store.flush()
+
+    def takeStats(self):
+        '''
+        Return the counts since the last call and reset them (used to collect worker stats).
+        '''
+        stats = self.stats
+        self.stats = {key: 0 for key in stats}
+        return stats
+
+    def addStats(self, stats):
+        for key, value in stats.items():
+            self.stats[key] += value
+
+    def report(self):
+        total = sum(self.stats.values())
+        if total == 0:
+            return 'Lexicon cache: no lookups'
+
+        rates = ', '.join(
+            f'{key} {value} ({100 * value / total:.1f}%)'
+            for key, value in self.stats.items()
+        )
+        return f'Lexicon cache: {total} lookups, {rates}'
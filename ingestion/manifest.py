@@ -0,0 +1,148 @@
+'''
+Run manifests for resumable ingestion.
+One JSON file per source under ingestion/cache/runs/ records the media_index ranges
+of the chunks that were written and of the ones still in flight, plus how many
+snippets, samples and translations were written. A resumed run skips the written
+ranges and redoes only the in-flight ones (the interfaces ignore rows they already have).
+The ranges only mean the same thing for the same extraction options (page range,
+splitter settings), so those are stored too and a resume must match them.
+'''
+
+import json
+import os
+import time
+from bisect import bisect_right
+from hashlib import sha256
+
+from caches import CACHE_DIR
+
+MANIFEST_DIR = os.path.join(CACHE_DIR, 'runs')
+
+
+def addRange(ranges, start, end):
+    '''
+    Insert [start, end] into sorted, disjoint ranges, merging neighbours.
+    '''
+    merged = []
+    for rangeStart, rangeEnd in sorted(ranges + [[start, end]]):
+        if merged and rangeStart <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], rangeEnd)
+        else:
+            merged.append([rangeStart, rangeEnd])
+
+    return merged
+
+def inRanges(ranges, value):
+    i = bisect_right(ranges, [value, float('inf')]) - 1
+    return i >= 0 and ranges[i][0] <= value <= ranges[i][1]
+
+
+class RunManifest:
+    def __init__(self, sourcePath, options=None, directory=MANIFEST_DIR):
+        os.makedirs(directory, exist_ok=True)
+        key = sha256(os.path.abspath(sourcePath).encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(directory, f'{os.path.basename(sourcePath)}-{key}.json')
+        self.sourcePath = sourcePath
+        # Round-tripped through JSON, so it compares equal to the stored copy
+        self.options = json.loads(json.dumps(options or {}))
+
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                self.data = json.load(file)
+        else:
+            self.reset(save=False)
+
+    def reset(self, save=True):
+        self.data = {
+            'source_path': self.sourcePath,
+            'options': self.options,
+            'completed': [],
+            'started': [],
+            'redo': [],
+            'snippets': 0,
+            'samples': 0,
+            'translated': 0,
+            'finished': False,
+            'updated_at': None,
+        }
+        if save:
+            self.save()
+
+    def save(self):
+        # Written to a temp file first, so a crash never leaves half a manifest
+        self.data['updated_at'] = time.time()
+        tempPath = self.path + '.tmp'
+        with open(tempPath, 'w') as file:
+            json.dump(self.data, file)
+        os.replace(tempPath, self.path)
+
+    @property
+    def finished(self):
+        return self.data['finished']
+
+    def canResume(self):
+        '''
+        Whether this run extracts the source the same way as the recorded one.
+        '''
+        return self.data.get('options') == self.options
+
+    def mismatch(self):
+        stored = self.data.get('options') or {}
+        keys = sorted(set(stored) | set(self.options))
+        return ', '.join(
+            f'{key}: {stored.get(key)} -> {self.options.get(key)}'
+            for key in keys if stored.get(key) != self.options.get(key)
+        )
+
+    def isCompleted(self, mediaIndex):
+        return inRanges(self.data['completed'], mediaIndex)
+
+    def isStarted(self, mediaIndex):
+        return inRanges(self.data['started'], mediaIndex) or inRanges(self.data['redo'], mediaIndex)
+
+    def resume(self):
+        '''
+        Start another run over the source. The chunks that were in flight are kept as
+        redo ranges until this run finishes, since it may chunk them differently.
+        '''
+        for start, end in self.data['started']:
+            self.data['redo'] = addRange(self.data['redo'], start, end)
+        self.data['started'] = []
+        self.save()
+
+    def chunkRange(self, chunk):
+        indexes = [item['media_index'] for item in chunk]
+        return [min(indexes), max(indexes)]
+
+    def start(self, chunk):
+        # One range per chunk (not merged), so each is dropped when its chunk is written
+        self.data['started'] = sorted(self.data['started'] + [self.chunkRange(chunk)])
+        self.data['finished'] = False
+        self.save()
+
+    def complete(self, chunk, snippetCount, sampleCount):
+        start, end = self.chunkRange(chunk)
+        self.data['started'] = [
+            started for started in self.data['started'] if started != [start, end]
+        ]
+        self.data['completed'] = addRange(self.data['completed'], start, end)
+        self.data['snippets'] += snippetCount
+        self.data['samples'] += sampleCount
+        self.data['translated'] += len(chunk)
+        self.save()
+
+    def finish(self):
+        '''
+        Mark the source done, unless a chunk failed and is still waiting to be redone.
+        '''
+        self.data['redo'] = []
+        self.data['finished'] = not self.data['started']
+        self.save()
+
+    def report(self):
+        return (
+            f"Run manifest for {self.sourcePath}: {self.data['snippets']} snippets, "
+            f"{self.data['samples']} samples, {self.data['translated']} translated, "
+            f"{len(self.data['started']) + len(self.data['redo'])} chunk ranges to redo"
+            f"{', finished' if self.finished else ''}"
+        )
@@ -1,61 +1,139 @@
 import os
 import json
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import pdfplumber
+from pdfminer.pdftypes import resolve1
 from tqdm import tqdm
 import argparse
 
-import spacy
-nlp = spacy.load('pt_core_news_sm')
-
-from clean import process_lines, split_sentences
-from ingest import ingestNew
+from clean import TAIL_CONTEXT_CHARS, process_lines, iter_sentences
 
 parser = argparse.ArgumentParser(description='Process a directory of pdfs')
 parser.add_argument('--flush', action='store_true', help='Overwrite the existing entries in the database')
 parser.add_argument('--size', type=int, default=50, help='Size for chunks of entries to be processed at a time')
 parser.add_argument('--delay', type=float, default=0, help='Number of seconds to wait between chunks of entries')
 parser.add_argument('--pages', type=int, default=-1, help='Number of pages to ingest (default: -1 for all)')
-args = parser.parse_args()
+parser.add_argument('--workers', type=int, default=1, help='Number of processes to extract pages and lemmatize chunks with (default: 1)')
+parser.add_argument('--resume', action='store_true', help='Continue from the run manifests of an interrupted run (with the same --pages and page ranges)')
+parser.add_argument('--translators', type=int, default=None, help="Number of chunks translating at once (default: a CachedTranslator's concurrency, otherwise 1)")
 
-def pdf_to_text(pdfPath, meta, literal_page_nums=True, page_limit=None):
-    with pdfplumber.open(pdfPath) as pdf:
-        print(f"Processing doc: {pdfPath}")
-        print(f"  with {len(pdf.pages)} pages")
-
-        start_page = meta.get('start_page', 1) - 1
-        end_page = meta.get('end_page', float('inf')) - 1
-        if page_limit and page_limit > 0:
-            end_page = min(end_page, start_page + page_limit)
-
-        # Get all the lines from all the pages
-        textLines = []
-        pageNums = []
-
-        print(f"ITERATIVELY READING PAGES...")
-        with tqdm(total=len(pdf.pages)) as pbar:
-            for i, page in tqdm(enumerate(pdf.pages[:end_page])):
-                if (i < start_page) or (i+1 > end_page):
-                    pbar.update(1)
-                    continue
-
-                lines = page.extract_text_lines()
-                processed, pageNum = process_lines(lines)
-
-                textLines.extend(processed)
-                if literal_page_nums:
-                    pageNums.extend([i+1] * len(processed))
-                else:
-                    pageNums.extend([pageNum] * len(processed))
+# Pages each extraction task reads before handing its lines back
+PAGES_PER_TASK = 8
 
+
+def pdf_page_count(pdfPath):
+    '''
+    Read the page count from the page tree, without building any page objects.
+    '''
+    with pdfplumber.open(pdfPath) as pdf:
+        return resolve1(pdf.doc.catalog['Pages'])['Count']
+
+
+def extract_pages(pdfPath, pageNumbers, literal_page_nums=True):
+    '''
+    Extract the cleaned lines of some pages (1-indexed) as [(lines, page number), ...].
+    Opens its own handle so it can run in a worker process.
+    '''
+    out = []
+    with pdfplumber.open(pdfPath, pages=pageNumbers) as pdf:
+        for pageNumber, page in zip(pageNumbers, pdf.pages):
+            lines = page.extract_text_lines()
+            processed, pageNum = process_lines(lines)
+            out.append((processed, pageNumber if literal_page_nums else pageNum))
+
+            # Drop the parsed layout objects as soon as the page is done
+            page.close()
+
+    return out
+
+
+def extraction_options(meta, page_limit):
+    '''
+    The settings that decide which sentences are extracted and their media indexes.
+    A run manifest can only be resumed with the same ones.
+    '''
+    return {
+        'start_page': meta.get('start_page', 1),
+        'end_page': meta.get('end_page'),
+        'page_limit': page_limit,
+        'language': 'portuguese',
+        'tail_context_chars': TAIL_CONTEXT_CHARS,
+    }
+
+
+def iter_pdf_lines(pdfPath, meta, literal_page_nums=True, page_limit=None, workers=1):
+    '''
+    Yield (line, page number) pairs in page order.
+    With workers > 1, page ranges are extracted in worker processes, keeping only
+    a few ranges in flight so memory stays flat however long the document is.
+    '''
+    pageCount = pdf_page_count(pdfPath)
+    print(f"Processing doc: {pdfPath}")
+    print(f"  with {pageCount} pages")
+
+    start_page = meta.get('start_page', 1) - 1
+    end_page = meta.get('end_page', float('inf')) - 1
+    if page_limit and page_limit > 0:
+        end_page = min(end_page, start_page + page_limit)
+    end_page = min(end_page, pageCount)
+
+    pageNumbers = list(range(start_page + 1, int(end_page) + 1))
+    tasks = [pageNumbers[i:i+PAGES_PER_TASK] for i in range(0, len(pageNumbers), PAGES_PER_TASK)]
+
+    def results():
+        if workers <= 1:
+            for task in tasks:
+                yield extract_pages(pdfPath, task, literal_page_nums)
+            return
+
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+            ) as pool:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.submit(extract_pages, pdfPath, task, literal_page_nums))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    print(f"READING PAGES...")
+    with tqdm(total=len(pageNumbers)) as pbar:
+        for pages in results():
+            for lines, pageNum in pages:
+                for line in lines:
+                    yield line, pageNum
                 pbar.update(1)
 
-        return textLines, pageNums
+
+def pdf_to_text(pdfPath, meta, literal_page_nums=True, page_limit=None, workers=1):
+    textLines = []
+    pageNums = []
+    for line, pageNum in iter_pdf_lines(pdfPath, meta, literal_page_nums, page_limit, workers):
+        textLines.append(line)
+        pageNums.append(pageNum)
+
+    return textLines, pageNums
 
 
 if __name__ == '__main__':
+    # Parsed and imported here so worker processes importing this module skip the setup
+    args = parser.parse_args()
+    from CONFIG import PreferredTranslator
+    from ingest import ingestNew
+    from lemmatizer import LEXICON
+    from manifest import RunManifest
+
     print(f"got args:")
     print(args)
 
+    # A chunk is usually a single batch, so a CachedTranslator only overlaps its batches
+    # when that many chunks translate at once. Other translators get one chunk at a time.
+    translators = args.translators or getattr(PreferredTranslator, 'concurrency', 1)
+
     if args.flush:
         from CONFIG import PreferredInterface as Interface
         Interface.flush()
@@ -71,36 +149,68 @@ if __name__ == '__main__':
         print(f"Got metadata: {METADATA}")
 
 
+    # Written chunks are recorded as they go, see manifest.py
+    manifests = {
+        pdf: RunManifest(f"{SOURCE_PATH}/{pdf}", extraction_options(METADATA[pdf], args.pages))
+        for pdf in pdfs
+    }
+    if args.resume and not args.flush:
+        # Checked before anything is ingested, the recorded ranges mean nothing for other options
+        mismatched = [
+            f"  {manifest.sourcePath} ({manifest.mismatch()})"
+            for manifest in manifests.values()
+            if not manifest.finished and manifest.data['completed'] and not manifest.canResume()
+        ]
+        if mismatched:
+            parser.error(
+                "cannot --resume, the extraction options changed since the last run:\n"
+                + '\n'.join(mismatched)
+                + "\nrerun with the same ones, or without --resume to start over"
+            )
+
     # Process Documents
     for pdf in pdfs:
         pdfPath = f"{SOURCE_PATH}/{pdf}"
 
+        manifest = manifests[pdf]
+        if args.resume and not args.flush:
+            if manifest.finished and manifest.canResume():
+                print(f"Skipping {pdfPath}, finished in an earlier run")
+                continue
+            if manifest.canResume():
+                manifest.resume()
+            else:
+                manifest.reset()
+        else:
+            manifest.reset()
+
         # Load text from file
         print(METADATA.keys(), pdf in METADATA.keys())
         doc_meta = METADATA[pdf]
-        text_lines, page_nums = pdf_to_text(
+        lines = iter_pdf_lines(
             pdfPath,
             doc_meta,
             page_limit=args.pages,
+            workers=args.workers,
         )
 
+        # Split the lines into sentences and page nums as they are extracted,
+        # and ingest them chunk by chunk while the rest of the doc is still being read
+        sents = iter_sentences(lines)
 
-        # Split the lines into sentences and page nums
-        sents = split_sentences(text_lines, page_nums)
-
-        # for sent in sents:
-        #     print(f"\t{sent['id']}")
-        #     print(f"\t{sent['page']}.{sent['page_sentence_index']}")
-        #     print(f"\t{sent['text']}")
-        #     print()
-        print(f"\nFound {len(sents)} sentences in doc\n")
-
-
-        # Check db for existing before processing
+        # Skips the ones already stored
         ingestNew(
             sents,
             sourceType='pdf',
             sourcePath=pdfPath,
             chunkSize=args.size,
             chunkDelay=args.delay,
+            workers=args.workers,
+            translateWorkers=translators,
+            manifest=manifest,
         )
+        print(manifest.report())
+
+    print(LEXICON.report())
+    if hasattr(PreferredTranslator, 'report'):
+        print(PreferredTranslator.report())
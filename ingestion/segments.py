@@ -0,0 +1,247 @@
+'''
+Append-only record storage for the offline interface.
+Records are appended as JSON lines to segment files and never rewritten in place.
+An append-only index log maps each id to (segment, offset, length), and reads
+go through mmap views of the segments. Overwritten records are dead bytes until
+a background compaction copies the live records into fresh segments.
+'''
+
+import json
+import mmap
+import os
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encodeRecord(record):
+    if orjson:
+        return orjson.dumps(record) + b'\n'
+    return json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+
+def decodeRecord(view):
+    # orjson parses straight from the mmap view, json needs a copy
+    if orjson:
+        return orjson.loads(view)
+    return json.loads(bytes(view))
+
+
+class SegmentStore:
+    '''
+    {id: record} store in one directory: segment-NNNNNN.jsonl files plus index.log.
+    '''
+    def __init__(self, directory, segmentSize=64 * 1024 * 1024, compactRatio=0.5):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.compactRatio = compactRatio
+        self.indexPath = os.path.join(directory, 'index.log')
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.compactor = None
+        self.maps = {}
+        self.index = {}
+        self.liveBytes = 0
+        self.deadBytes = 0
+
+        # Replay the index log, later entries win
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath, encoding='utf-8') as file:
+                for line in file:
+                    if line.strip():
+                        key, segment, offset, length = json.loads(line)
+                        self.setLocation(key, (segment, offset, length))
+
+        segments = [int(name.split('-')[1].split('.')[0]) for name in os.listdir(directory) if name.startswith('segment-')]
+        self.nextSegment = max(segments, default=-1) + 1
+        self.activeSegment = self.newSegment()
+        self.indexFile = open(self.indexPath, 'a', encoding='utf-8')
+
+    def segmentPath(self, segment):
+        return os.path.join(self.directory, f'segment-{segment:06d}.jsonl')
+
+    def newSegment(self):
+        segment = self.nextSegment
+        self.nextSegment += 1
+        return segment
+
+    def setLocation(self, key, location):
+        old = self.index.get(key)
+        if old:
+            self.liveBytes -= old[2]
+            self.deadBytes += old[2]
+        self.index[key] = location
+        self.liveBytes += location[2]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def ids(self):
+        with self.lock:
+            return list(self.index.keys())
+
+    # Reads
+
+    def view(self, location):
+        '''
+        A memoryview of one record, remapping the segment if it has grown since it was mapped.
+        '''
+        segment, offset, length = location
+        segmentMap = self.maps.get(segment)
+        if segmentMap is None or offset + length > len(segmentMap):
+            if segmentMap is not None:
+                segmentMap.close()
+            with open(self.segmentPath(segment), 'rb') as file:
+                segmentMap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = segmentMap
+
+        return memoryview(segmentMap)[offset:offset + length]
+
+    def get(self, key, default=None):
+        with self.lock:
+            location = self.index.get(key)
+            if location is None:
+                return default
+
+            view = self.view(location)
+            try:
+                return decodeRecord(view)
+            finally:
+                view.release()
+
+    def getMany(self, keys):
+        return [self.get(key) for key in keys if key in self.index]
+
+    # Writes
+
+    def append(self, records):
+        '''
+        Append {id: record} to the active segment, then log the new locations.
+        '''
+        with self.lock:
+            locations = {}
+            path = self.segmentPath(self.activeSegment)
+            offset = os.path.getsize(path) if os.path.exists(path) else 0
+            file = open(path, 'ab')
+            try:
+                for key, record in records.items():
+                    if offset >= self.segmentSize:
+                        file.close()
+                        self.activeSegment = self.newSegment()
+                        path = self.segmentPath(self.activeSegment)
+                        file = open(path, 'ab')
+                        offset = 0
+
+                    data = encodeRecord(record)
+                    file.write(data)
+                    locations[key] = (self.activeSegment, offset, len(data))
+                    offset += len(data)
+            finally:
+                file.close()
+
+            # Only log locations once the records are on disk
+            for key, location in locations.items():
+                self.indexFile.write(json.dumps([key, *location]) + '\n')
+                self.setLocation(key, location)
+            self.indexFile.flush()
+
+        if self.deadBytes > self.compactRatio * max(self.liveBytes, 1):
+            self.compactInBackground()
+
+    def clear(self):
+        self.waitForCompaction()
+        with self.lock:
+            for segmentMap in self.maps.values():
+                segmentMap.close()
+            self.maps = {}
+            self.indexFile.close()
+            for name in os.listdir(self.directory):
+                if name.startswith('segment-'):
+                    os.remove(os.path.join(self.directory, name))
+
+            self.index = {}
+            self.liveBytes = 0
+            self.deadBytes = 0
+            self.nextSegment = 0
+            self.activeSegment = self.newSegment()
+            self.indexFile = open(self.indexPath, 'w', encoding='utf-8')
+
+    # Compaction
+
+    def compactInBackground(self):
+        with self.lock:
+            if self.compactor and self.compactor.is_alive():
+                return
+            self.compactor = threading.Thread(target=self.compact, daemon=True)
+            self.compactor.start()
+
+    def waitForCompaction(self):
+        compactor = self.compactor
+        if compactor and compactor.is_alive() and compactor is not threading.current_thread():
+            compactor.join()
+
+    def compact(self):
+        '''
+        Copy the live records into new segments and drop the old ones.
+        Appends keep going to a fresh active segment while this runs.
+        '''
+        with self.lock:
+            self.activeSegment = self.newSegment()
+            snapshot = dict(self.index)
+            oldSegments = {location[0] for location in snapshot.values()}
+            outputSegment = self.newSegment()
+
+        moved = {}
+        output = open(self.segmentPath(outputSegment), 'ab')
+        offset = 0
+        try:
+            for key, location in snapshot.items():
+                with self.lock:
+                    view = self.view(location)
+                    data = bytes(view)
+                    view.release()
+
+                if offset >= self.segmentSize:
+                    output.close()
+                    with self.lock:
+                        outputSegment = self.newSegment()
+                    output = open(self.segmentPath(outputSegment), 'ab')
+                    offset = 0
+
+                output.write(data)
+                moved[key] = (location, (outputSegment, offset, len(data)))
+                offset += len(data)
+        finally:
+            output.close()
+
+        with self.lock:
+            # Records overwritten during the copy keep their newer location
+            for key, (old, new) in moved.items():
+                if self.index.get(key) == old:
+                    self.index[key] = new
+
+            # Rewrite the index log with only the current locations
+            tempPath = self.indexPath + '.tmp'
+            with open(tempPath, 'w', encoding='utf-8') as file:
+                for key, location in self.index.items():
+                    file.write(json.dumps([key, *location]) + '\n')
+            self.indexFile.close()
+            os.replace(tempPath, self.indexPath)
+            self.indexFile = open(self.indexPath, 'a', encoding='utf-8')
+
+            for segment in oldSegments:
+                segmentMap = self.maps.pop(segment, None)
+                if segmentMap is not None:
+                    segmentMap.close()
+                path = self.segmentPath(segment)
+                if os.path.exists(path):
+                    os.remove(path)
+
+            self.liveBytes = sum(location[2] for location in self.index.values())
+            self.deadBytes = 0
@@ -0,0 +1,116 @@
+'''
+Tests for CachedTranslator: cache hits, batch limits, output order and how many
+batches it keeps in flight against a translator with latency.
+Run from the repo root with: python -m pytest
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from translators import BaseTranslator, CachedTranslator, LatencyStub
+
+
+class RecordingStub(BaseTranslator):
+    '''
+    Translates by upper-casing, and records the batch of every call.
+    '''
+    def __init__(self):
+        self.metaName = 'recording-stub'
+        self.ogLanguage = 'portuguese'
+        self.userLanguage = 'english'
+        self.batches = []
+
+    def translate(self, text):
+        self.batches.append(list(text))
+        return [sent.upper() for sent in text]
+
+
+@pytest.fixture
+def stub():
+    return RecordingStub()
+
+def cached(stub, tmp_path, **kwargs):
+    return CachedTranslator(stub, path=str(tmp_path / 'translations.sqlite'), **kwargs)
+
+
+def test_cache_hits_skip_the_translator(stub, tmp_path):
+    translator = cached(stub, tmp_path)
+    sents = ['um gato', 'dois gatos', 'um gato']
+
+    assert translator.translate(sents) == ['UM GATO', 'DOIS GATOS', 'UM GATO']
+    # The repeated sentence is only sent once
+    assert stub.batches == [['um gato', 'dois gatos']]
+
+    assert translator.translate(sents) == ['UM GATO', 'DOIS GATOS', 'UM GATO']
+    assert len(stub.batches) == 1
+    assert translator.stats == {'cached': 4, 'translated': 2}
+
+def test_cache_is_kept_between_instances(stub, tmp_path):
+    cached(stub, tmp_path).translate(['um gato'])
+
+    again = RecordingStub()
+    assert cached(again, tmp_path).translate('um gato') == 'UM GATO'
+    assert again.batches == []
+
+def test_only_misses_are_sent(stub, tmp_path):
+    translator = cached(stub, tmp_path)
+    translator.translate(['um gato'])
+
+    assert translator.translate(['um cão', 'um gato', 'um rato']) == ['UM CÃO', 'UM GATO', 'UM RATO']
+    assert stub.batches[1:] == [['um cão', 'um rato']]
+
+def test_batches_respect_batch_size(stub, tmp_path):
+    translator = cached(stub, tmp_path, batchSize=3, concurrency=1)
+    sents = [f'frase {i}' for i in range(10)]
+
+    translator.translate(sents)
+    assert [len(batch) for batch in stub.batches] == [3, 3, 3, 1]
+
+def test_batches_respect_batch_chars(stub, tmp_path):
+    translator = cached(stub, tmp_path, batchSize=100, batchChars=20, concurrency=1)
+    sents = ['a' * 8, 'b' * 8, 'c' * 8, 'd' * 30, 'e' * 5]
+
+    translator.translate(sents)
+    assert stub.batches == [['a' * 8, 'b' * 8], ['c' * 8], ['d' * 30], ['e' * 5]]
+    # A sentence longer than batchChars still goes out, alone
+    for batch in stub.batches:
+        assert len(batch) == 1 or sum(len(sent) for sent in batch) <= 20
+
+@pytest.mark.parametrize('concurrency', [1, 4])
+def test_order_is_preserved(stub, tmp_path, concurrency):
+    translator = cached(stub, tmp_path, batchSize=7, concurrency=concurrency)
+    translator.translate([f'frase {i}' for i in range(0, 100, 3)])
+
+    sents = [f'frase {i}' for i in range(100)]
+    assert translator.translate(sents) == [sent.upper() for sent in sents]
+
+def test_short_answer_is_an_error(tmp_path):
+    class Short(RecordingStub):
+        def translate(self, text):
+            return super().translate(text)[:-1]
+
+    with pytest.raises(ValueError):
+        cached(Short(), tmp_path).translate(['um gato', 'dois gatos'])
+
+def test_batches_overlap_up_to_concurrency(tmp_path):
+    stub = LatencyStub(latency=0.05, perSentence=0)
+    translator = cached(stub, tmp_path, batchSize=2, concurrency=3)
+    sents = [f'frase {i}' for i in range(20)]
+
+    assert translator.translate(sents) == sents
+    assert stub.calls == 10
+    assert 1 < stub.peakInFlight <= 3
+
+def test_concurrency_is_shared_by_all_callers(tmp_path):
+    # Like ingest.py, several chunks translating at once on their own threads
+    stub = LatencyStub(latency=0.05, perSentence=0)
+    translator = cached(stub, tmp_path, batchSize=2, concurrency=3)
+    chunks = [[f'frase {i}-{j}' for j in range(6)] for i in range(8)]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(translator.translate, chunks))
+
+    assert results == chunks
+    assert stub.calls == 24
+    assert 1 < stub.peakInFlight <= 3
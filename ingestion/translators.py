@@ -1,7 +1,14 @@
 # TODO: Make generic translator class, and then inherit from it for each specific translator
 import os
-
+import threading
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+
+from caches import CACHE_DIR, SqliteStore
+
+TRANSLATION_CACHE_PATH = os.path.join(CACHE_DIR, 'translations.sqlite')
 
 class BaseTranslator(ABC):
     '''
@@ -37,11 +44,10 @@ class Google(BaseTranslator):
         This can be swapped out for a different translator if desired.
         '''
         if type(text) == str:
-            translationResult = self.translator.translate(text, src='pt', dest='en')
-        else:
-            translationResult = [self.translator.translate(t, src='pt', dest='en') for t in text]
+            return self.translator.translate(text, src='pt', dest='en').text
 
-        return translationResult.text
+        # A list is sent as one call, which returns the translations in the same order
+        return [result.text for result in self.translator.translate(list(text), src='pt', dest='en')]
 
 
 class HuggingFace(BaseTranslator):
@@ -109,3 +115,135 @@ class DeepL(BaseTranslator):
         else:
             result = self.translator.translate_text(text, target_lang='EN-US')
             return [item.text for item in result]
+
+
+class LatencyStub(BaseTranslator):
+    '''
+    Returns the text unchanged after sleeping like a remote API would:
+    latency per call plus perSentence for every sentence. For tests and benchTranslate.py.
+    Counts the calls, and the most of them that were in flight at once (peakInFlight).
+    '''
+    def __init__(self, latency=0.2, perSentence=0.005):
+        self.metaName = 'latency-stub'
+        self.ogLanguage = 'portuguese'
+        self.userLanguage = 'english'
+        self.latency = latency
+        self.perSentence = perSentence
+        self.calls = 0
+        self.inFlight = 0
+        self.peakInFlight = 0
+        self.lock = threading.Lock()
+
+    def translate(self, text):
+        with self.lock:
+            self.calls += 1
+            self.inFlight += 1
+            self.peakInFlight = max(self.peakInFlight, self.inFlight)
+
+        sents = [text] if type(text) == str else text
+        time.sleep(self.latency + self.perSentence * len(sents))
+
+        with self.lock:
+            self.inFlight -= 1
+        return text if type(text) == str else list(sents)
+
+
+class CachedTranslator(BaseTranslator):
+    '''
+    Wraps a translator with a persistent cache keyed by (metaName, sha256 of the sentence),
+    so re-ingesting a document only pays for sentences it has not translated before.
+    Misses are deduplicated, split into batches of at most batchSize sentences and
+    batchChars characters, and sent on one pool of concurrency threads. The pool is shared
+    by every thread calling translate(), so at most concurrency batches are in flight in total.
+    Keep concurrency at 1 for local models (HuggingFace), which gain nothing from threads.
+    '''
+    def __init__(self, translator, path=TRANSLATION_CACHE_PATH, batchSize=50, batchChars=5000, concurrency=4):
+        self.translator = translator
+        self.metaName = translator.metaName
+        self.ogLanguage = translator.ogLanguage
+        self.userLanguage = translator.userLanguage
+        self.batchSize = batchSize
+        self.batchChars = batchChars
+        self.concurrency = concurrency
+        self.store = SqliteStore(path, 'translations')
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+
+        # Sentences answered by the cache or sent to the translator
+        self.stats = {'cached': 0, 'translated': 0}
+        self.statsLock = threading.Lock()
+
+    def cacheKey(self, sentence):
+        return f"{self.metaName}:{sha256(sentence.encode('utf-8')).hexdigest()}"
+
+    def batches(self, sents):
+        batch, chars = [], 0
+        for sent in sents:
+            if batch and (len(batch) == self.batchSize or chars + len(sent) > self.batchChars):
+                yield batch
+                batch, chars = [], 0
+            batch.append(sent)
+            chars += len(sent)
+
+        if batch:
+            yield batch
+
+    def translateBatch(self, batch):
+        translations = self.translator.translate(batch)
+        if len(translations) != len(batch):
+            raise ValueError(f"{self.metaName} returned {len(translations)} translations for {len(batch)} sentences")
+
+        return translations
+
+    def translate(self, text):
+        if type(text) == str:
+            return self.translate([text])[0]
+
+        keys = [self.cacheKey(sent) for sent in text]
+        found = self.store.getMany(keys)
+
+        # Each missing sentence is sent once, however often it repeats
+        misses = {}
+        for key, sent in zip(keys, text):
+            if key not in found:
+                misses.setdefault(key, sent)
+
+        with self.statsLock:
+            self.stats['cached'] += len(text) - len(misses)
+            self.stats['translated'] += len(misses)
+
+        if misses:
+            batches = list(self.batches(list(misses.values())))
+            jobs = [self.pool.submit(self.translateBatch, batch) for batch in batches]
+
+            # Keep the batches that succeeded even if another one failed
+            error = None
+            translated = {}
+            for batch, job in zip(batches, jobs):
+                try:
+                    translated.update(zip(batch, job.result()))
+                except Exception as e:
+                    error = error or e
+
+            results = {key: translated[sent] for key, sent in misses.items() if sent in translated}
+            self.store.setMany(results)
+            self.store.flush()
+            found.update(results)
+
+            if error:
+                raise error
+
+        return [found[key] for key in keys]
+
+    def report(self):
+        with self.statsLock:
+            stats = dict(self.stats)
+
+        total = sum(stats.values())
+        if total == 0:
+            return 'Translation cache: no lookups'
+
+        rates = ', '.join(
+            f'{key} {value} ({100 * value / total:.1f}%)'
+            for key, value in stats.items()
+        )
+        return f'Translation cache: {total} sentences, {rates}'
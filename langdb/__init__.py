@@ -0,0 +1,4 @@
+'''
+Code shared by the ingestion scripts and the server.
+Install it from the repo root with `pip install -e .` (part of requirements.txt).
+'''
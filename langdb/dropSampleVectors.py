@@ -0,0 +1,28 @@
+'''
+Remove the old per-sample vector arrays, once every vocab item has its packed vector
+(the vocab_vectors backfill). This frees the space they take but cannot be undone,
+so it is run by hand rather than at startup.
+Run with: python -m langdb.dropSampleVectors [--sqlite PATH] [--mongo URI] [--db language]
+'''
+
+import argparse
+
+import pymongo
+
+from langdb.migrations import SQLITE_DEFAULT_PATH, connectSqlite, dropSampleVectors, dropSqliteSampleVectors
+
+parser = argparse.ArgumentParser(description='Drop the vector arrays stored on the samples')
+parser.add_argument('--sqlite', nargs='?', const=SQLITE_DEFAULT_PATH, default=None, help='Use the SQLite file (default path if none given) instead of Mongo')
+parser.add_argument('--mongo', default='mongodb://localhost:27017/', help='Mongo URI')
+parser.add_argument('--db', default='language', help='Mongo database name')
+parser.add_argument('--batch', type=int, default=1000, help='Samples per batch')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.sqlite:
+        count = dropSqliteSampleVectors(connectSqlite(args.sqlite), batchSize=args.batch)
+        print(f"Dropped the vectors of {count} samples in {args.sqlite}")
+    else:
+        count = dropSampleVectors(pymongo.MongoClient(args.mongo)[args.db], batchSize=args.batch)
+        print(f"Dropped the vectors of {count} samples in {args.db}")
@@ -0,0 +1,581 @@
+'''
+Index bootstrap and data migrations for the `language` database.
+Both the Flask app and the ingestion MongoInterface call migrate() at startup.
+Indexes are (re)declared every time, which is a no-op once they exist.
+Backfills run once and are recorded in the `migrations` collection. Each one is
+claimed there before it runs, so processes starting together do not run it twice.
+The SQLite backend gets the same tables and indexes from migrateSqlite().
+'''
+
+import json
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+import pymongo
+import pymongo.errors
+
+from langdb.scoring import DEFAULT_REPETITION_CONSTANTS, repDataDueTime
+from langdb.vectors import packVector
+
+INDEXES = {
+    'vocab': [
+        {
+            'keys': [('id', 1)],
+            'unique': True,
+            'covers': ['POST /rep vocab fetch', 'ingestion vocab updates'],
+        },
+    ],
+    'vocab_due': [
+        {
+            'keys': [('id', 1)],
+            'unique': True,
+            'covers': ['POST /rep queue key upsert', 'ingestion vocab inserts'],
+        },
+        {
+            'keys': [('next_review', 1), ('word_freq', -1)],
+            'covers': ['GET /snippets best vocab'],
+        },
+    ],
+    'rep_state': [
+        {
+            'keys': [('user_id', 1), ('vocab_id', 1)],
+            'unique': True,
+            'covers': ['POST /rep state fetch and upsert'],
+        },
+        {
+            'keys': [('user_id', 1), ('next_review', 1), ('word_freq', -1)],
+            'covers': ['GET /rep rank_type=recent'],
+        },
+        {
+            'keys': [('user_id', 1), ('next_review_average', 1), ('word_freq', -1)],
+            'covers': ['GET /rep rank_type=average'],
+        },
+    ],
+    'rep_log': [
+        {
+            'keys': [('user_id', 1), ('vocab_id', 1), ('time', 1)],
+            'covers': ['review history of a user\'s vocab item'],
+        },
+    ],
+    'snippets': [
+        {
+            'keys': [('id', 1)],
+            'unique': True,
+            'covers': ['GET /snippets', 'GET /rep', 'GET /next_media_snippet current snippet', 'ingestion dedup'],
+        },
+        {
+            'keys': [('source_path', 1), ('media_index', 1)],
+            'covers': ['GET /next_media_snippet next snippet'],
+        },
+    ],
+    'samples': [
+        {
+            'keys': [('specific_id', 1)],
+            'unique': True,
+            'covers': ['sample lookups by id'],
+        },
+        {
+            'keys': [('vocab_id', 1)],
+            'covers': ['samples of a vocab item'],
+        },
+    ],
+    'user_settings': [
+        {
+            'keys': [('username', 1)],
+            'unique': True,
+            'covers': ['GET/POST /user by username', 'GET/POST /rep user settings'],
+        },
+    ],
+}
+
+
+# SQLite mirror of the collections above. Documents are stored as JSON in `doc`,
+# and the fields that queries filter or sort on are copied into indexed columns.
+SQLITE_DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'language.sqlite')
+
+SQLITE_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS vocab ('
+    ' id TEXT PRIMARY KEY, word_freq REAL, next_review REAL, next_review_average REAL, doc TEXT NOT NULL,'
+    ' vect BLOB)',
+    'CREATE INDEX IF NOT EXISTS vocab_next_review ON vocab (next_review, word_freq DESC)',
+    'CREATE INDEX IF NOT EXISTS vocab_next_review_average ON vocab (next_review_average, word_freq DESC)',
+    'CREATE TABLE IF NOT EXISTS vocab_due ('
+    ' id TEXT PRIMARY KEY, word_freq REAL, next_review REAL)',
+    'CREATE INDEX IF NOT EXISTS vocab_due_next_review ON vocab_due (next_review, word_freq DESC)',
+    'CREATE TABLE IF NOT EXISTS snippets ('
+    ' id TEXT PRIMARY KEY, source_path TEXT, media_index INTEGER, doc TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS snippets_source_media ON snippets (source_path, media_index)',
+    'CREATE TABLE IF NOT EXISTS samples ('
+    ' specific_id TEXT PRIMARY KEY, vocab_id TEXT, doc TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS samples_vocab_id ON samples (vocab_id)',
+    'CREATE TABLE IF NOT EXISTS user_settings ('
+    ' id TEXT PRIMARY KEY, username TEXT UNIQUE NOT NULL, doc TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS rep_state ('
+    ' user_id TEXT NOT NULL, vocab_id TEXT NOT NULL, word_freq REAL,'
+    ' last_review REAL, last_strength TEXT, average_strength REAL, history_length INTEGER,'
+    ' next_review REAL, next_review_average REAL,'
+    ' PRIMARY KEY (user_id, vocab_id))',
+    'CREATE INDEX IF NOT EXISTS rep_state_next_review ON rep_state (user_id, next_review, word_freq DESC)',
+    'CREATE INDEX IF NOT EXISTS rep_state_next_review_average ON rep_state (user_id, next_review_average, word_freq DESC)',
+    'CREATE TABLE IF NOT EXISTS rep_log ('
+    ' user_id TEXT NOT NULL, vocab_id TEXT NOT NULL, strength TEXT, time REAL)',
+    'CREATE INDEX IF NOT EXISTS rep_log_user_vocab ON rep_log (user_id, vocab_id, time)',
+    'CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY, applied_at TEXT, updated INTEGER)',
+]
+
+# Columns added after a table was first created: (table, column, type)
+SQLITE_ADDED_COLUMNS = [
+    ('vocab', 'vect', 'BLOB'),
+]
+
+
+def backfillRepDueTimes(db):
+    '''
+    Reviewed vocab written before due times were stored has no /rep sort key.
+    There is no user to take constants from, so this uses the defaults.
+    '''
+    constants = DEFAULT_REPETITION_CONSTANTS
+    query = {
+        'rep_data.last_review': {'$ne': None},
+        'rep_data.next_review': {'$exists': False},
+    }
+    updates = []
+    for doc in db['vocab'].find(query, {'_id': 1, 'rep_data': 1}):
+        repData = doc['rep_data']
+        updates.append(pymongo.UpdateOne({'_id': doc['_id']}, {'$set': {
+            'rep_data.next_review': repDataDueTime(
+                repData['last_review'],
+                constants['S'],
+                constants['curve_shapes'][repData['last_strength']],
+            ),
+            'rep_data.next_review_average': repDataDueTime(
+                repData['last_review'],
+                constants['S'],
+                repData['average_strength'],
+            ),
+        }}))
+
+    if updates:
+        db['vocab'].bulk_write(updates, ordered=False)
+
+    return len(updates)
+
+# The user who inherits the review state that used to be shared (see backfillUserRepState).
+# Defaults to the first user that was created.
+LEGACY_USERNAME = os.environ.get('LANGUAGE_LEGACY_USERNAME')
+
+def legacyUserId(db):
+    query = {'username': LEGACY_USERNAME} if LEGACY_USERNAME else {}
+    doc = db['user_settings'].find_one(query, {'_id': 1}, sort=[('_id', 1)])
+    return str(doc['_id']) if doc else None
+
+def backfillUserRepState(db, batchSize=1000):
+    '''
+    Review state used to be shared by everyone on the vocab docs. The legacy user
+    (the one who made those reviews) starts from that shared state, and its history
+    becomes their rep_log. Other users start fresh. The vocab docs are left as they are.
+    Returns None (so it runs again on the next start) while there is no such user.
+    Safe to rerun: the log entries get an _id from (user, vocab item, history index).
+    '''
+    userId = legacyUserId(db)
+    if userId is None:
+        return None
+
+    states = []
+    logs = []
+    count = 0
+    def write():
+        if states:
+            db['rep_state'].bulk_write(states, ordered=False)
+        if logs:
+            db['rep_log'].bulk_write(logs, ordered=False)
+        states.clear()
+        logs.clear()
+
+    query = {'rep_data.last_review': {'$ne': None}}
+    for doc in db['vocab'].find(query, {'_id': 0, 'id': 1, 'word_freq': 1, 'rep_data': 1}):
+        repData = doc['rep_data']
+        states.append(pymongo.UpdateOne(
+            {'user_id': userId, 'vocab_id': doc['id']},
+            {'$setOnInsert': {
+                'word_freq': doc['word_freq'],
+                'last_review': repData['last_review'],
+                'last_strength': repData['last_strength'],
+                'average_strength': repData['average_strength'],
+                'history_length': repData['history_length'],
+                'next_review': repData.get('next_review'),
+                'next_review_average': repData.get('next_review_average'),
+            }},
+            upsert=True,
+        ))
+        logs.extend(
+            pymongo.UpdateOne(
+                {'_id': f"{userId}:{doc['id']}:{i}"},
+                {'$setOnInsert': {
+                    'user_id': userId,
+                    'vocab_id': doc['id'],
+                    'strength': entry['strength'],
+                    'time': entry['time'],
+                }},
+                upsert=True,
+            )
+            for i, entry in enumerate(repData.get('history', []))
+        )
+        count += 1
+
+        if len(states) >= batchSize:
+            write()
+
+    write()
+    return count
+
+def backfillVocabDue(db, batchSize=1000):
+    '''
+    The /snippets queue used to sort the vocab docs by rep_data.next_review.
+    Every vocab item gets its small vocab_due doc with that sort key.
+    '''
+    updates = []
+    count = 0
+    for doc in db['vocab'].find({}, {'_id': 0, 'id': 1, 'word_freq': 1, 'rep_data.next_review': 1}):
+        updates.append(pymongo.UpdateOne(
+            {'id': doc['id']},
+            {'$setOnInsert': {
+                'word_freq': doc['word_freq'],
+                'next_review': doc.get('rep_data', {}).get('next_review'),
+            }},
+            upsert=True,
+        ))
+        count += 1
+        if len(updates) >= batchSize:
+            db['vocab_due'].bulk_write(updates, ordered=False)
+            updates = []
+
+    if updates:
+        db['vocab_due'].bulk_write(updates, ordered=False)
+
+    return count
+
+def backfillVocabVectors(db, batchSize=1000):
+    '''
+    Samples used to carry their own vector as an array of doubles. Each vocab item
+    gets the vector of its first sample (by specific_id) as packed bytes.
+    The sample arrays are kept; dropSampleVectors() removes them when run by hand.
+    '''
+    firstVectors = db['samples'].aggregate(
+        [
+            {'$match': {'vect': {'$exists': True}}},
+            {'$sort': {'vocab_id': 1, 'specific_id': 1}},
+            {'$group': {'_id': '$vocab_id', 'vect': {'$first': '$vect'}}},
+        ],
+        allowDiskUse=True,
+    )
+
+    updates = []
+    count = 0
+    for doc in firstVectors:
+        updates.append(pymongo.UpdateOne(
+            {'id': doc['_id'], 'vect': {'$exists': False}},
+            {'$set': {'vect': packVector(doc['vect'])}},
+        ))
+        count += 1
+        if len(updates) >= batchSize:
+            db['vocab'].bulk_write(updates, ordered=False)
+            updates = []
+
+    if updates:
+        db['vocab'].bulk_write(updates, ordered=False)
+
+    return count
+
+def dropSampleVectors(db, batchSize=1000):
+    '''
+    Remove the old vector arrays from the samples, in batches, once their vocab item
+    has its packed vector (see backfillVocabVectors). This cannot be undone, so it is
+    not a startup backfill: run `python -m langdb.dropSampleVectors`.
+    Returns the number of samples changed.
+    '''
+    count = 0
+    lastId = None
+    while True:
+        query = {'vect': {'$exists': True}}
+        if lastId is not None:
+            query['_id'] = {'$gt': lastId}
+        samples = list(db['samples'].find(query, {'_id': 1, 'vocab_id': 1}).sort('_id', 1).limit(batchSize))
+        if not samples:
+            return count
+        lastId = samples[-1]['_id']
+
+        vocabIds = list({sample['vocab_id'] for sample in samples})
+        packed = {
+            doc['id']
+            for doc in db['vocab'].find({'id': {'$in': vocabIds}, 'vect': {'$exists': True}}, {'_id': 0, 'id': 1})
+        }
+        ids = [sample['_id'] for sample in samples if sample['vocab_id'] in packed]
+        if ids:
+            count += db['samples'].update_many({'_id': {'$in': ids}}, {'$unset': {'vect': ''}}).modified_count
+
+# Applied in order, each at most once per database
+BACKFILLS = [
+    ('vocab_rep_due_times', backfillRepDueTimes),
+    ('user_rep_state', backfillUserRepState),
+    ('vocab_due', backfillVocabDue),
+    ('vocab_vectors', backfillVocabVectors),
+]
+
+
+def ensureIndexes(db):
+    '''
+    Create every declared index. Returns one report entry per index.
+    '''
+    report = []
+    for collectionName, indexes in INDEXES.items():
+        collection = db[collectionName]
+        for index in indexes:
+            entry = {
+                'collection': collectionName,
+                'keys': index['keys'],
+                'unique': index.get('unique', False),
+                'covers': index['covers'],
+            }
+            try:
+                entry['name'] = collection.create_index(index['keys'], unique=entry['unique'])
+                entry['status'] = 'ok'
+            except pymongo.errors.OperationFailure as e:
+                # Most likely existing duplicates blocking a unique index
+                entry['name'] = None
+                entry['status'] = f'failed: {e}'
+            report.append(entry)
+
+    return report
+
+# A claim older than this is taken to be from a process that died mid-backfill,
+# and the backfill is run again (they are all safe to rerun)
+BACKFILL_LEASE = timedelta(hours=1)
+
+def claimBackfill(db, name):
+    '''
+    Atomically mark a backfill as running in this process. False if it is done,
+    or running in another process that claimed it less than BACKFILL_LEASE ago.
+    '''
+    now = datetime.utcnow()
+    try:
+        db['migrations'].insert_one({'_id': name, 'state': 'running', 'started_at': now})
+        return True
+    except pymongo.errors.DuplicateKeyError:
+        pass
+
+    stale = db['migrations'].find_one_and_update(
+        {'_id': name, 'state': 'running', 'started_at': {'$lt': now - BACKFILL_LEASE}},
+        {'$set': {'started_at': now}},
+    )
+    return stale is not None
+
+def runBackfills(db):
+    '''
+    Run the backfills that have not been recorded yet. Returns {name: docs updated}.
+    '''
+    results = {}
+    for name, backfill in BACKFILLS:
+        if not claimBackfill(db, name):
+            continue
+
+        try:
+            results[name] = backfill(db)
+        except BaseException:
+            # Released, so the next start tries again
+            db['migrations'].delete_one({'_id': name, 'state': 'running'})
+            raise
+
+        if results[name] is None:
+            db['migrations'].delete_one({'_id': name, 'state': 'running'})
+            continue
+        db['migrations'].update_one(
+            {'_id': name},
+            {'$set': {'state': 'done', 'applied_at': datetime.utcnow(), 'updated': results[name]}},
+        )
+
+    return results
+
+def migrate(db, verbose=True):
+    if verbose:
+        print(f"Checking indexes and migrations for database: {db.name}")
+
+    report = ensureIndexes(db)
+    backfills = runBackfills(db)
+
+    if verbose:
+        for entry in report:
+            keys = ', '.join(f'{key} {direction}' for key, direction in entry['keys'])
+            unique = ' unique' if entry['unique'] else ''
+            print(f"  [{entry['status']}] {entry['collection']} ({keys}){unique} -> {'; '.join(entry['covers'])}")
+        for name, count in backfills.items():
+            if count is None:
+                print(f"  backfill {name}: deferred")
+            else:
+                print(f"  backfill {name}: updated {count} docs")
+
+    return {
+        'indexes': report,
+        'backfills': backfills,
+    }
+
+
+def connectSqlite(path=SQLITE_DEFAULT_PATH, timeout=30):
+    connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    # WAL keeps the database consistent on a crash without syncing every commit
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+def backfillSqliteVocabVectors(connection):
+    '''
+    Same as backfillVocabVectors, for sample docs stored as JSON.
+    '''
+    rows = connection.execute(
+        "SELECT vocab_id, json_extract(doc, '$.vect') FROM samples"
+        " WHERE json_extract(doc, '$.vect') IS NOT NULL ORDER BY vocab_id, specific_id"
+    )
+    vectors = {}
+    for vocabId, vector in rows:
+        vectors.setdefault(vocabId, vector)
+
+    connection.executemany(
+        'UPDATE vocab SET vect = ? WHERE id = ? AND vect IS NULL',
+        [(packVector(json.loads(vector)), vocabId) for vocabId, vector in vectors.items()],
+    )
+    return len(vectors)
+
+def dropSqliteSampleVectors(connection, batchSize=1000):
+    '''
+    Same as dropSampleVectors, for sample docs stored as JSON.
+    Each batch is its own transaction, so the server's writes are not held up for long.
+    '''
+    count = 0
+    lastRowid = 0
+    while True:
+        with connection:
+            rows = connection.execute(
+                'SELECT samples.rowid FROM samples JOIN vocab ON vocab.id = samples.vocab_id'
+                " WHERE samples.rowid > ? AND json_extract(samples.doc, '$.vect') IS NOT NULL"
+                ' AND vocab.vect IS NOT NULL ORDER BY samples.rowid LIMIT ?',
+                (lastRowid, batchSize),
+            ).fetchall()
+            if not rows:
+                return count
+            lastRowid = rows[-1][0]
+
+            count += connection.executemany(
+                "UPDATE samples SET doc = json_remove(doc, '$.vect') WHERE rowid = ?",
+                rows,
+            ).rowcount
+
+def backfillSqliteUserRepState(connection):
+    '''
+    Same as backfillUserRepState, for vocab docs stored as JSON.
+    rep_log rows have no id, so an entry is skipped if the user already has one
+    for the vocab item at the same time (served by rep_log_user_vocab).
+    '''
+    if LEGACY_USERNAME:
+        user = connection.execute(
+            'SELECT id FROM user_settings WHERE username = ?', (LEGACY_USERNAME,)
+        ).fetchone()
+    else:
+        user = connection.execute('SELECT id FROM user_settings ORDER BY rowid LIMIT 1').fetchone()
+    if user is None:
+        return None
+
+    userId = user[0]
+    rows = connection.execute(
+        "SELECT id, word_freq, json_extract(doc, '$.rep_data') FROM vocab"
+        " WHERE json_extract(doc, '$.rep_data.last_review') IS NOT NULL"
+    ).fetchall()
+
+    states = []
+    logs = []
+    for vocabId, wordFreq, repData in rows:
+        repData = json.loads(repData)
+        states.append((
+            userId,
+            vocabId,
+            wordFreq,
+            repData['last_review'],
+            repData['last_strength'],
+            repData['average_strength'],
+            repData['history_length'],
+            repData.get('next_review'),
+            repData.get('next_review_average'),
+        ))
+        logs.extend(
+            (userId, vocabId, entry['strength'], entry['time'])
+            for entry in repData.get('history', [])
+        )
+
+    connection.executemany(
+        'INSERT OR IGNORE INTO rep_state (user_id, vocab_id, word_freq, last_review, last_strength,'
+        ' average_strength, history_length, next_review, next_review_average)'
+        ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        states,
+    )
+    connection.executemany(
+        'INSERT INTO rep_log (user_id, vocab_id, strength, time) SELECT ?, ?, ?, ?'
+        ' WHERE NOT EXISTS (SELECT 1 FROM rep_log WHERE user_id = ? AND vocab_id = ? AND time = ?)',
+        [(*log, log[0], log[1], log[3]) for log in logs],
+    )
+    return len(states)
+
+def backfillSqliteVocabDue(connection):
+    '''
+    Same as backfillVocabDue, from the old sort columns of the vocab table.
+    '''
+    return connection.execute(
+        'INSERT OR IGNORE INTO vocab_due (id, word_freq, next_review)'
+        ' SELECT id, word_freq, next_review FROM vocab'
+    ).rowcount
+
+SQLITE_BACKFILLS = [
+    ('user_rep_state', backfillSqliteUserRepState),
+    ('vocab_due', backfillSqliteVocabDue),
+    ('vocab_vectors', backfillSqliteVocabVectors),
+]
+
+def migrateSqlite(connection, verbose=True):
+    if verbose:
+        print("Checking tables and indexes for sqlite database")
+
+    for statement in SQLITE_SCHEMA:
+        connection.execute(statement)
+
+    for table, column, columnType in SQLITE_ADDED_COLUMNS:
+        columns = {row[1] for row in connection.execute(f'PRAGMA table_info({table})')}
+        if column not in columns:
+            connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {columnType}')
+
+    connection.commit()
+
+    # The write lock is held from the check to the commit, so another process
+    # starting at the same time waits and then finds the backfills recorded
+    connection.execute('BEGIN IMMEDIATE')
+    applied = {row[0] for row in connection.execute('SELECT name FROM migrations')}
+    for name, backfill in SQLITE_BACKFILLS:
+        if name in applied:
+            continue
+
+        try:
+            updated = backfill(connection)
+        except BaseException:
+            connection.rollback()
+            raise
+
+        if updated is None:
+            if verbose:
+                print(f"  backfill {name}: deferred")
+            continue
+        connection.execute(
+            'INSERT INTO migrations (name, applied_at, updated) VALUES (?, ?, ?)',
+            (name, datetime.utcnow().isoformat(), updated),
+        )
+        if verbose:
+            print(f"  backfill {name}: updated {updated} rows")
+
+    connection.commit()
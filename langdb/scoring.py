@@ -0,0 +1,94 @@
+'''
+Retention scoring for the spaced repetition ranking.
+RepScores holds the rep data of many vocab items as contiguous NumPy columns,
+so ranking them is one vectorized exp and an argpartition instead of a Python loop.
+'''
+
+import math
+import numpy as np
+
+# Retention level at which a reviewed word counts as due again.
+# The due time for this level is stored on each vocab doc so /rep can rank with an index.
+REP_RETENTION_THRESHOLD = 0.5
+
+DEFAULT_REPETITION_CONSTANTS = {
+    "S": 2670,
+    "curve_shapes": {
+        "again": 1,
+        "hard": 2,
+        "good": 4,
+        "easy": 6,
+    }
+}
+
+def repDataCurveEquation(timeDelta, S, alpha):
+    return math.e ** (-timeDelta / (alpha * S))
+
+def repDataDueTime(lastReview, S, alpha):
+    '''
+    Time at which repDataCurveEquation drops below REP_RETENTION_THRESHOLD.
+    '''
+    return lastReview + alpha * S * math.log(1 / REP_RETENTION_THRESHOLD)
+
+
+class RepScores:
+    def __init__(self, ids, lastReviews, lastAlphas, alphaSums, historyLengths):
+        self.ids = np.asarray(ids, dtype=object)
+        self.lastReviews = np.ascontiguousarray(lastReviews, dtype=np.float64)
+        self.lastAlphas = np.ascontiguousarray(lastAlphas, dtype=np.float64)
+        self.alphaSums = np.ascontiguousarray(alphaSums, dtype=np.float64)
+        self.historyLengths = np.ascontiguousarray(historyLengths, dtype=np.float64)
+
+    @classmethod
+    def fromDocs(cls, docs, userDiffs):
+        '''
+        Load the columns from vocab docs projected to id and the scalar rep_data fields.
+        The running alpha sum is average_strength * history_length, so history is never read.
+        '''
+        ids = []
+        lastReviews = []
+        lastAlphas = []
+        alphaSums = []
+        historyLengths = []
+        for doc in docs:
+            repData = doc['rep_data']
+            ids.append(doc['id'])
+            lastReviews.append(repData['last_review'])
+            lastAlphas.append(userDiffs[repData['last_strength']])
+            alphaSums.append(repData['average_strength'] * repData['history_length'])
+            historyLengths.append(repData['history_length'])
+
+        return cls(ids, lastReviews, lastAlphas, alphaSums, historyLengths)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def alphas(self, rankType):
+        if rankType == 'recent':
+            return self.lastAlphas
+        elif rankType == 'average':
+            return self.alphaSums / self.historyLengths
+        raise ValueError(f'Unknown rank type: {rankType}')
+
+    def retention(self, currTime, S, rankType='recent'):
+        '''
+        repDataCurveEquation for every item at once.
+        '''
+        return np.exp(-(currTime - self.lastReviews) / (self.alphas(rankType) * S))
+
+    def lowest(self, N, currTime, S, rankType='recent'):
+        '''
+        The N items with the lowest retention as (-rankValue, id) pairs, most forgotten first.
+        Same items as pushing every score through a size N heapq.
+        '''
+        if N <= 0 or len(self) == 0:
+            return []
+
+        scores = self.retention(currTime, S, rankType)
+        if N < len(scores):
+            best = np.argpartition(scores, N - 1)[:N]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(scores[best], kind='stable')]
+
+        return [(-float(scores[i]), self.ids[i]) for i in best]
@@ -0,0 +1,19 @@
+'''
+Binary encoding of word vectors, shared by ingestion and the server.
+Each vocab item stores one vector as raw VECTOR_DTYPE bytes (BSON binary in
+Mongo, a BLOB column in SQLite) instead of every sample carrying an array of doubles.
+'''
+
+import numpy as np
+
+VECTOR_DTYPE = np.float16
+
+
+def packVector(vector):
+    return np.asarray(vector, dtype=VECTOR_DTYPE).tobytes()
+
+def unpackVector(blob):
+    '''
+    The stored bytes as a float32 array (a copy, safe to modify).
+    '''
+    return np.frombuffer(blob, dtype=VECTOR_DTYPE).astype(np.float32)
@@ -0,0 +1,621 @@
+'''
+Data access for the API routes, mirroring the interfaces in ingestion/interfaces.py.
+Every backend answers the same queries and returns documents in the same shape
+(Mongo's, without _id except on user docs), so the routes do not depend on which
+one serverConfig.py selects.
+'''
+
+import json
+import queue
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+import pymongo
+import pymongo.errors
+from bson.objectid import ObjectId
+from pymongo import ReadPreference
+
+from langdb.migrations import connectSqlite, migrate, migrateSqlite
+
+
+class BaseBackend(ABC):
+    '''
+    This class is used to check that all backends have the required methods.
+    '''
+    @abstractmethod
+    def bestVocab(self, N):
+        '''
+        N vocab docs: unreviewed first, then by due time and word frequency.
+        '''
+        pass
+
+    @abstractmethod
+    def dueVocab(self, userId, rankType, N):
+        '''
+        The N vocab items the user reviewed that are furthest past their due time
+        for the rank type, as {'id', 'rep_data', 'parents'} docs.
+        '''
+        pass
+
+    @abstractmethod
+    def repStates(self, userId, ids):
+        '''
+        {id: {'word_freq', 'average_strength', 'history_length'}} of the user
+        for the ids that are stored (defaults for vocab they never reviewed).
+        '''
+        pass
+
+    @abstractmethod
+    def logReviews(self, userId, reviews):
+        '''
+        Apply reviews: [{'id', 'word_freq', 'set': state fields, 'history': new log entries}].
+        Returns {id: error message} for the ones that failed.
+        '''
+        pass
+
+    @abstractmethod
+    def vocabVectors(self, after=None):
+        '''
+        ([(id, packed vector)], watermark) for the vocab with a vector stored after
+        the watermark of an earlier call (all of them when after is None).
+        '''
+        pass
+
+    @abstractmethod
+    def snippetsByIds(self, ids):
+        pass
+
+    @abstractmethod
+    def snippetById(self, snippetId):
+        pass
+
+    @abstractmethod
+    def snippetAt(self, sourcePath, mediaIndex):
+        pass
+
+    @abstractmethod
+    def snippetRange(self, sourcePath, startIndex, count):
+        '''
+        Snippets of the source with startIndex <= media_index < startIndex + count, in order.
+        '''
+        pass
+
+    @abstractmethod
+    def findUser(self, username=None, userId=None):
+        '''
+        The user settings doc by username or ObjectId, or None.
+        '''
+        pass
+
+    @abstractmethod
+    def updateUser(self, userId, userDoc):
+        pass
+
+    @abstractmethod
+    def insertUser(self, userDoc):
+        '''
+        Returns the new user id as a string.
+        '''
+        pass
+
+
+class MongoBackend(BaseBackend):
+    READ_PREFERENCES = {
+        'primary': ReadPreference.PRIMARY,
+        'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+        'secondary': ReadPreference.SECONDARY,
+        'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+        'nearest': ReadPreference.NEAREST,
+    }
+    # Sort keys in rep_state holding the precomputed due time for each /rep rank type
+    REP_DUE_KEYS = {
+        'recent': 'next_review',
+        'average': 'next_review_average',
+    }
+    # Order of the /snippets queue: unreviewed vocab first, then by due time and frequency.
+    # It is read from the small vocab_due docs (its index), not from the large vocab docs.
+    BEST_VOCAB_SORT = [
+        ('next_review', 1),
+        ('word_freq', -1),
+    ]
+
+    def __init__(
+            self,
+            mongoURI,
+            dbName='language',
+            poolSize=10,
+            minPoolSize=0,
+            connectTimeoutMS=5_000,
+            serverSelectionTimeoutMS=5_000,
+            queryTimeoutMS=10_000,
+            poolWaitTimeoutMS=2_000,
+            readPreference='primary',
+        ):
+        if readPreference not in self.READ_PREFERENCES:
+            raise ValueError(f'Unknown read preference: {readPreference} (expected one of {list(self.READ_PREFERENCES)})')
+
+        self.client = pymongo.MongoClient(
+            mongoURI,
+            maxPoolSize=poolSize,
+            minPoolSize=minPoolSize,
+            connectTimeoutMS=connectTimeoutMS,
+            serverSelectionTimeoutMS=serverSelectionTimeoutMS,
+            socketTimeoutMS=queryTimeoutMS,
+            waitQueueTimeoutMS=poolWaitTimeoutMS,
+        )
+        self.db = self.client[dbName]
+        self.vocabCollection = self.db['vocab']
+        self.snippetsCollection = self.db['snippets']
+        self.userSettingsCollection = self.db['user_settings']
+        # Small fixed-size review state per (user_id, vocab_id), and every review appended to rep_log
+        self.repStateCollection = self.db['rep_state']
+        self.repLogCollection = self.db['rep_log']
+        # The /snippets sort key of every vocab item: {id, word_freq, next_review}
+        self.vocabDueCollection = self.db['vocab_due']
+
+        # The queue and snippet reads may go to secondaries. Reads that feed a
+        # write (rep data, users) use the primary handles above.
+        preference = self.READ_PREFERENCES[readPreference]
+        self.vocabReads = self.vocabCollection.with_options(read_preference=preference)
+        self.snippetsReads = self.snippetsCollection.with_options(read_preference=preference)
+        self.vocabDueReads = self.vocabDueCollection.with_options(read_preference=preference)
+
+        migrate(self.db)
+
+    def bestVocabCursor(self, N):
+        return self.vocabDueReads.find({}, {'_id': 0, 'id': 1}).sort(self.BEST_VOCAB_SORT).limit(N)
+
+    def dueStateCursor(self, userId, rankType, N):
+        dueKey = self.REP_DUE_KEYS[rankType]
+        return self.repStateCollection.find(
+            {'user_id': userId, dueKey: {'$ne': None}},
+            {
+                '_id': 0,
+                'vocab_id': 1,
+                'last_review': 1,
+                'last_strength': 1,
+                'average_strength': 1,
+                'history_length': 1,
+            },
+        ).sort([(dueKey, 1), ('word_freq', -1)]).limit(N)
+
+    def bestVocab(self, N):
+        # limit(0) means no limit, so never send it
+        if N <= 0:
+            return []
+
+        ids = [doc['id'] for doc in self.bestVocabCursor(N)]
+        docs = {
+            doc['id']: doc
+            for doc in self.vocabReads.find({'id': {'$in': ids}}, {'_id': 0, 'vect': 0})
+        }
+        return [docs[vocabId] for vocabId in ids if vocabId in docs]
+
+    def dueVocab(self, userId, rankType, N):
+        if N <= 0:
+            return []
+
+        states = list(self.dueStateCursor(userId, rankType, N))
+        parents = {
+            doc['id']: doc['parents']
+            for doc in self.vocabReads.find(
+                {'id': {'$in': [state['vocab_id'] for state in states]}},
+                {'_id': 0, 'id': 1, 'parents': 1},
+            )
+        }
+
+        vocab = []
+        for state in states:
+            vocabId = state.pop('vocab_id')
+            vocab.append({'id': vocabId, 'rep_data': state, 'parents': parents.get(vocabId, [])})
+
+        return vocab
+
+    def repStates(self, userId, ids):
+        ids = list(set(ids))
+        states = {
+            doc['vocab_id']: doc
+            for doc in self.repStateCollection.find(
+                {'user_id': userId, 'vocab_id': {'$in': ids}},
+                {'_id': 0, 'vocab_id': 1, 'word_freq': 1, 'average_strength': 1, 'history_length': 1},
+            )
+        }
+
+        # Only vocab the user never reviewed needs the vocab collection
+        unseen = [vId for vId in ids if vId not in states]
+        if unseen:
+            for doc in self.vocabCollection.find({'id': {'$in': unseen}}, {'_id': 0, 'id': 1, 'word_freq': 1}):
+                states[doc['id']] = {'word_freq': doc['word_freq'], 'average_strength': 1, 'history_length': 0}
+
+        return states
+
+    def logReviews(self, userId, reviews):
+        if not reviews:
+            return {}
+
+        updates = [
+            pymongo.UpdateOne(
+                {'user_id': userId, 'vocab_id': review['id']},
+                {
+                    '$set': review['set'],
+                    '$inc': {'history_length': len(review['history'])},
+                    '$setOnInsert': {'word_freq': review['word_freq']},
+                },
+                upsert=True,
+            )
+            for review in reviews
+        ]
+
+        errors = {}
+        try:
+            self.repStateCollection.bulk_write(updates, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                errors[reviews[error['index']]['id']] = error['errmsg']
+
+        logs = [
+            {'user_id': userId, 'vocab_id': review['id'], **entry}
+            for review in reviews if review['id'] not in errors
+            for entry in review['history']
+        ]
+        try:
+            self.repLogCollection.insert_many(logs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                errors[logs[error['index']]['vocab_id']] = error['errmsg']
+
+        # The /snippets queue follows the latest review of the item by any user
+        dueIds = [review['id'] for review in reviews if review['id'] not in errors]
+        dueUpdates = [
+            pymongo.UpdateOne(
+                {'id': review['id']},
+                {
+                    '$set': {'next_review': review['set']['next_review']},
+                    '$setOnInsert': {'word_freq': review['word_freq']},
+                },
+                upsert=True,
+            )
+            for review in reviews if review['id'] not in errors
+        ]
+        try:
+            if dueUpdates:
+                self.vocabDueCollection.bulk_write(dueUpdates, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                errors[dueIds[error['index']]] = error['errmsg']
+
+        return errors
+
+    def vocabVectors(self, after=None):
+        # New vocab docs get a larger _id, so it doubles as the watermark
+        query = {'vect': {'$exists': True}}
+        if after is not None:
+            query['_id'] = {'$gt': after}
+
+        rows = []
+        for doc in self.vocabReads.find(query, {'_id': 1, 'id': 1, 'vect': 1}).sort('_id', 1):
+            rows.append((doc['id'], doc['vect']))
+            after = doc['_id']
+
+        return rows, after
+
+    def snippetsByIds(self, ids):
+        return list(self.snippetsReads.find({'id': {'$in': list(ids)}}, {'_id': 0}))
+
+    def snippetById(self, snippetId):
+        return self.snippetsReads.find_one({'id': snippetId})
+
+    def snippetAt(self, sourcePath, mediaIndex):
+        return self.snippetsReads.find_one({
+            'media_index': mediaIndex,
+            'source_path': sourcePath,
+        })
+
+    def snippetRange(self, sourcePath, startIndex, count):
+        return list(self.snippetRangeCursor(sourcePath, startIndex, count))
+
+    def snippetRangeCursor(self, sourcePath, startIndex, count):
+        return self.snippetsReads.find({
+            'source_path': sourcePath,
+            'media_index': {'$gte': startIndex, '$lt': startIndex + count},
+        }).sort([('source_path', 1), ('media_index', 1)])
+
+    def findUser(self, username=None, userId=None):
+        query = {'_id': userId} if userId else {'username': username}
+        return self.userSettingsCollection.find_one(query)
+
+    def updateUser(self, userId, userDoc):
+        return self.userSettingsCollection.update_one({'_id': userId}, {'$set': userDoc}).raw_result
+
+    def insertUser(self, userDoc):
+        return str(self.userSettingsCollection.insert_one(userDoc).inserted_id)
+
+
+class SqlitePool:
+    '''
+    Up to `size` connections, each used by one request at a time.
+    In WAL mode the readers run alongside the one writer.
+    '''
+    def __init__(self, path, size=10, waitTimeout=2.0, busyTimeout=10.0):
+        self.path = path
+        self.size = size
+        self.waitTimeout = waitTimeout
+        self.busyTimeout = busyTimeout
+        self.idle = queue.Queue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if self.opened < self.size:
+                self.opened += 1
+                return connectSqlite(self.path, timeout=self.busyTimeout)
+
+        try:
+            return self.idle.get(timeout=self.waitTimeout)
+        except queue.Empty:
+            raise TimeoutError(f'No free sqlite connection after {self.waitTimeout} s (pool size {self.size})')
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.idle.put(connection)
+
+
+class SqliteBackend(BaseBackend):
+    '''
+    Reads the file the ingestion SqliteInterface writes. Documents are JSON in the
+    `doc` column, and the sort and filter fields are indexed columns (see langdb/migrations.py).
+    '''
+    REP_DUE_COLUMNS = {
+        'recent': 'next_review',
+        'average': 'next_review_average',
+    }
+    # Unreviewed vocab has a NULL due time, which sorts first like in Mongo.
+    # The order comes from the small vocab_due rows, the docs are looked up by id.
+    BEST_VOCAB_SQL = (
+        'SELECT vocab.doc FROM vocab_due JOIN vocab ON vocab.id = vocab_due.id'
+        ' ORDER BY vocab_due.next_review, vocab_due.word_freq DESC LIMIT ?'
+    )
+    DUE_STATE_SQL = (
+        'SELECT vocab_id, last_review, last_strength, average_strength, history_length'
+        ' FROM rep_state WHERE user_id = ? AND {due} IS NOT NULL'
+        ' ORDER BY {due}, word_freq DESC LIMIT ?'
+    )
+    VOCAB_VECTORS_SQL = 'SELECT rowid, id, vect FROM vocab WHERE rowid > ? AND vect IS NOT NULL ORDER BY rowid'
+    # The /snippets queue follows the latest review of the item by any user
+    VOCAB_DUE_SQL = (
+        'INSERT INTO vocab_due (id, word_freq, next_review) VALUES (?, ?, ?)'
+        ' ON CONFLICT (id) DO UPDATE SET next_review = excluded.next_review'
+    )
+    SNIPPET_AT_SQL = 'SELECT doc FROM snippets WHERE source_path = ? AND media_index = ?'
+    SNIPPET_RANGE_SQL = (
+        'SELECT doc FROM snippets WHERE source_path = ? AND media_index >= ? AND media_index < ?'
+        ' ORDER BY media_index'
+    )
+
+    # Stay under SQLite's bound parameter limit
+    CHUNK_SIZE = 500
+
+    def __init__(self, path, poolSize=10, queryTimeoutMS=10_000, poolWaitTimeoutMS=2_000):
+        self.path = path
+        self.pool = SqlitePool(
+            path,
+            size=poolSize,
+            waitTimeout=poolWaitTimeoutMS / 1000,
+            busyTimeout=queryTimeoutMS / 1000,
+        )
+        with self.pool.connection() as connection:
+            migrateSqlite(connection)
+
+    def execute(self, sql, params=()):
+        with self.pool.connection() as connection:
+            return connection.execute(sql, params).fetchall()
+
+    def executeWrite(self, sql, params=(), many=False):
+        '''
+        Run one statement (or executemany) in its own transaction. Returns the row count.
+        '''
+        with self.pool.connection() as connection, connection:
+            if many:
+                return connection.executemany(sql, params).rowcount
+            return connection.execute(sql, params).rowcount
+
+    def rowsIn(self, sql, keys, params=()):
+        '''
+        Rows of sql (ending in "IN ({})") for every chunk of keys.
+        '''
+        keys = list(keys)
+        rows = []
+        for i in range(0, len(keys), self.CHUNK_SIZE):
+            chunk = keys[i:i+self.CHUNK_SIZE]
+            rows.extend(self.execute(sql.format(', '.join('?' * len(chunk))), [*params, *chunk]))
+
+        return rows
+
+    def docsIn(self, table, keyColumn, keys):
+        rows = self.rowsIn(f'SELECT doc FROM {table} WHERE {keyColumn} IN ({{}})', keys)
+        return [json.loads(row[0]) for row in rows]
+
+    def bestVocab(self, N):
+        return [json.loads(row[0]) for row in self.execute(self.BEST_VOCAB_SQL, (N,))]
+
+    def dueVocab(self, userId, rankType, N):
+        sql = self.DUE_STATE_SQL.format(due=self.REP_DUE_COLUMNS[rankType])
+        states = self.execute(sql, (userId, N))
+        parents = dict(self.rowsIn(
+            "SELECT id, json_extract(doc, '$.parents') FROM vocab WHERE id IN ({})",
+            [row[0] for row in states],
+        ))
+
+        return [
+            {
+                'id': vocabId,
+                'rep_data': {
+                    'last_review': lastReview,
+                    'last_strength': lastStrength,
+                    'average_strength': averageStrength,
+                    'history_length': historyLength,
+                },
+                'parents': json.loads(parents.get(vocabId) or '[]'),
+            }
+            for (vocabId, lastReview, lastStrength, averageStrength, historyLength) in states
+        ]
+
+    def repStates(self, userId, ids):
+        ids = set(ids)
+        states = {
+            vocabId: {'word_freq': wordFreq, 'average_strength': averageStrength, 'history_length': historyLength}
+            for (vocabId, wordFreq, averageStrength, historyLength) in self.rowsIn(
+                'SELECT vocab_id, word_freq, average_strength, history_length'
+                ' FROM rep_state WHERE user_id = ? AND vocab_id IN ({})',
+                ids,
+                params=(userId,),
+            )
+        }
+
+        unseen = [vId for vId in ids if vId not in states]
+        for (vocabId, wordFreq) in self.rowsIn('SELECT id, word_freq FROM vocab WHERE id IN ({})', unseen):
+            states[vocabId] = {'word_freq': wordFreq, 'average_strength': 1, 'history_length': 0}
+
+        return states
+
+    def logReviews(self, userId, reviews):
+        stateRows = [
+            (
+                userId,
+                review['id'],
+                review['word_freq'],
+                review['set']['last_review'],
+                review['set']['last_strength'],
+                review['set']['average_strength'],
+                len(review['history']),
+                review['set']['next_review'],
+                review['set']['next_review_average'],
+            )
+            for review in reviews
+        ]
+        logRows = [
+            (userId, review['id'], entry['strength'], entry['time'])
+            for review in reviews
+            for entry in review['history']
+        ]
+        dueRows = [
+            (review['id'], review['word_freq'], review['set']['next_review'])
+            for review in reviews
+        ]
+
+        # The state upsert, its log entries and the queue sort key commit together
+        with self.pool.connection() as connection, connection:
+            connection.executemany(
+                'INSERT INTO rep_state (user_id, vocab_id, word_freq, last_review, last_strength,'
+                ' average_strength, history_length, next_review, next_review_average)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT (user_id, vocab_id) DO UPDATE SET'
+                ' last_review = excluded.last_review,'
+                ' last_strength = excluded.last_strength,'
+                ' average_strength = excluded.average_strength,'
+                ' history_length = history_length + excluded.history_length,'
+                ' next_review = excluded.next_review,'
+                ' next_review_average = excluded.next_review_average',
+                stateRows,
+            )
+            connection.executemany(
+                'INSERT INTO rep_log (user_id, vocab_id, strength, time) VALUES (?, ?, ?, ?)',
+                logRows,
+            )
+            connection.executemany(self.VOCAB_DUE_SQL, dueRows)
+
+        return {}
+
+    def vocabVectors(self, after=None):
+        # The upsert keeps the rowid of existing vocab, so new rows have larger ones
+        rows = self.execute(self.VOCAB_VECTORS_SQL, (after or 0,))
+        if rows:
+            after = rows[-1][0]
+
+        return [(vocabId, vect) for _, vocabId, vect in rows], after
+
+    def snippetsByIds(self, ids):
+        return self.docsIn('snippets', 'id', ids)
+
+    def snippetById(self, snippetId):
+        docs = self.docsIn('snippets', 'id', [snippetId])
+        return docs[0] if docs else None
+
+    def snippetAt(self, sourcePath, mediaIndex):
+        rows = self.execute(self.SNIPPET_AT_SQL, (sourcePath, mediaIndex))
+        return json.loads(rows[0][0]) if rows else None
+
+    def snippetRange(self, sourcePath, startIndex, count):
+        rows = self.execute(self.SNIPPET_RANGE_SQL, (sourcePath, startIndex, startIndex + count))
+        return [json.loads(row[0]) for row in rows]
+
+    def findUser(self, username=None, userId=None):
+        if userId:
+            rows = self.execute('SELECT id, doc FROM user_settings WHERE id = ?', (str(userId),))
+        else:
+            rows = self.execute('SELECT id, doc FROM user_settings WHERE username = ?', (username,))
+
+        if not rows:
+            return None
+
+        userDoc = json.loads(rows[0][1])
+        userDoc['_id'] = ObjectId(rows[0][0])
+        return userDoc
+
+    def updateUser(self, userId, userDoc):
+        userDoc = {key: value for key, value in userDoc.items() if key != '_id'}
+        count = self.executeWrite(
+            'UPDATE user_settings SET username = ?, doc = ? WHERE id = ?',
+            (userDoc['username'], json.dumps(userDoc), str(userId)),
+        )
+
+        # Same shape as Mongo's raw update result
+        return {'n': count, 'nModified': count, 'ok': 1.0, 'updatedExisting': count > 0}
+
+    def insertUser(self, userDoc):
+        userId = userDoc.get('_id', ObjectId())
+        userDoc = {key: value for key, value in userDoc.items() if key != '_id'}
+        self.executeWrite(
+            'INSERT INTO user_settings (id, username, doc) VALUES (?, ?, ?)',
+            (str(userId), userDoc['username'], json.dumps(userDoc)),
+        )
+
+        return str(userId)
+
+
+def createBackend(config):
+    '''
+    The backend named by config.DB_BACKEND, with the pool settings from config.
+    '''
+    if config.DB_BACKEND == 'mongo':
+        return MongoBackend(
+            config.MONGO_URI,
+            config.MONGO_DB,
+            poolSize=config.DB_POOL_SIZE,
+            minPoolSize=config.DB_MIN_POOL_SIZE,
+            connectTimeoutMS=config.DB_CONNECT_TIMEOUT_MS,
+            serverSelectionTimeoutMS=config.DB_SERVER_SELECTION_TIMEOUT_MS,
+            queryTimeoutMS=config.DB_QUERY_TIMEOUT_MS,
+            poolWaitTimeoutMS=config.DB_POOL_WAIT_TIMEOUT_MS,
+            readPreference=config.MONGO_READ_PREFERENCE,
+        )
+    if config.DB_BACKEND == 'sqlite':
+        return SqliteBackend(
+            config.SQLITE_PATH,
+            poolSize=config.DB_POOL_SIZE,
+            queryTimeoutMS=config.DB_QUERY_TIMEOUT_MS,
+            poolWaitTimeoutMS=config.DB_POOL_WAIT_TIMEOUT_MS,
+        )
+
+    raise ValueError(f'Unknown DB_BACKEND: {config.DB_BACKEND} (expected mongo or sqlite)')
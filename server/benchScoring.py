@@ -0,0 +1,86 @@
+'''
+Benchmark RepScores against the per-doc loop /rep used to rank with.
+Run with: python benchScoring.py
+'''
+
+import heapq
+import random
+import time
+
+from langdb.scoring import RepScores, repDataCurveEquation
+
+S = 2670
+USER_DIFFS = {
+    "again": 1,
+    "hard": 2,
+    "good": 4,
+    "easy": 6,
+}
+SIZES = [10_000, 100_000, 1_000_000]
+N = 10
+
+def makeDocs(count, currTime):
+    strengths = list(USER_DIFFS.keys())
+    docs = []
+    for i in range(count):
+        history = [
+            {'strength': random.choice(strengths), 'time': 0}
+            for _ in range(random.randint(1, 5))
+        ]
+        values = [USER_DIFFS[item['strength']] for item in history]
+        docs.append({
+            'id': f'word{i} - NOUN',
+            'rep_data': {
+                'last_review': currTime - random.uniform(0, 3 * 24 * 3600),
+                'last_strength': history[-1]['strength'],
+                'average_strength': sum(values) / len(values),
+                'history_length': len(history),
+                'history': history,
+            },
+        })
+    return docs
+
+def loopRank(docs, currTime, rankType):
+    heap = []
+    for doc in docs:
+        repData = doc['rep_data']
+        timeDelta = currTime - repData['last_review']
+
+        if rankType == 'recent':
+            alpha = USER_DIFFS[repData['last_strength']]
+            rankValue = repDataCurveEquation(timeDelta, S, alpha)
+        elif rankType == 'average':
+            historyValues = [USER_DIFFS[item['strength']] for item in repData['history']]
+            avgAlpha = sum(historyValues) / len(historyValues)
+            rankValue = repDataCurveEquation(timeDelta, S, avgAlpha)
+
+        item = doc['id']
+        if len(heap) < N:
+            heapq.heappush(heap, (-rankValue, item))
+        else:
+            heapq.heappushpop(heap, (-rankValue, item))
+    return heap
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    currTime = time.time()
+    for size in SIZES:
+        docs = makeDocs(size, currTime)
+        scores, loadTime = timed(lambda: RepScores.fromDocs(docs, USER_DIFFS))
+        print(f"{size} items (loading columns: {loadTime * 1000:.1f} ms)")
+
+        for rankType in ['recent', 'average']:
+            loopResult, loopTime = timed(lambda: loopRank(docs, currTime, rankType))
+            vecResult, vecTime = timed(lambda: scores.lowest(N, currTime, S, rankType=rankType))
+
+            same = {vId for _, vId in loopResult} == {vId for _, vId in vecResult}
+            print(
+                f"  {rankType:>7}: loop {loopTime * 1000:9.1f} ms"
+                f" | numpy {vecTime * 1000:7.1f} ms"
+                f" | {loopTime / vecTime:6.1f}x | same top {N}: {same}"
+            )
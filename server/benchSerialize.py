@@ -0,0 +1,91 @@
+'''
+Micro-benchmark of encoding a typical /snippets payload:
+the old json_util.dumps -> json.loads -> jsonify path against serialize.toJson.
+Run with: python benchSerialize.py [--vocab 20] [--repeat 200]
+'''
+
+import argparse
+import json
+import random
+import time
+from datetime import datetime
+
+from bson import json_util
+from bson.objectid import ObjectId
+
+import serialize
+from serialize import toJson
+
+parser = argparse.ArgumentParser(description='Benchmark response serialization')
+parser.add_argument('--vocab', type=int, default=20, help='Vocab items in the payload (2 snippets each)')
+parser.add_argument('--repeat', type=int, default=200, help='Encodes per timing')
+
+
+def fakeSnippet(i):
+    words = [random.choice(['casa', 'gato', 'então', 'ação', 'livro', 'água']) for _ in range(25)]
+    return {
+        '_id': ObjectId(),
+        'id': f'{i:064x}',
+        'page': i // 30,
+        'page_sentence_index': i % 30,
+        'combined_index': f'{i // 30}.{i % 30}',
+        'media_index': i,
+        'text': ' '.join(words),
+        'translation': ' '.join(words[::-1]),
+        'translation_model': 'dummy',
+        'target_language': 'pt',
+        'user_language': 'en',
+        'contained_samples': [f'{w} - NOUN - {j} - {i}' for j, w in enumerate(words)],
+        'contained_vocab': [f'{w} - NOUN' for w in words],
+        'texts': [{'text': w, 'lemma': w, 'pos': 'NOUN', 'whitespace': ' '} for w in words],
+        'source_type': 'pdf',
+        'source_path': 'media/livro.pdf',
+        'ingested_at': datetime(2024, 1, 1, 12, 0, i % 60),
+    }
+
+def fakeVocab(i):
+    return {
+        'id': f'palavra{i} - NOUN',
+        'lemma': f'palavra{i}',
+        'pos': 'NOUN',
+        'word_freq': random.uniform(2, 6),
+        'parents': [f'{j:064x}' for j in range(i, i + 40)],
+        'samples': [f'palavra{i} - NOUN - {j} - {j:064x}' for j in range(40)],
+        'rep_data': {
+            'last_review': None,
+            'last_strength': None,
+            'average_strength': 1,
+            'history_length': 0,
+            'next_review': None,
+            'next_review_average': None,
+        },
+        'tags': [],
+    }
+
+def oldEncode(data):
+    # What jsonify did with the json_util round-trip (outside debug mode)
+    return json.dumps(json.loads(json_util.dumps(data)), sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    payload = {
+        'vocab': [fakeVocab(i) for i in range(args.vocab)],
+        'snippets': [fakeSnippet(i) for i in range(2 * args.vocab)],
+    }
+
+    size = len(toJson(payload))
+    print(f"payload: {args.vocab} vocab, {2 * args.vocab} snippets, {size / 1024:.0f} KiB of JSON")
+    print(f"encoder: {'orjson' if serialize.orjson else 'json (orjson not installed)'}")
+    print(f"identical output: {json.loads(oldEncode(payload)) == json.loads(toJson(payload))}")
+
+    oldTime = timed(lambda: oldEncode(payload), args.repeat)
+    newTime = timed(lambda: toJson(payload), args.repeat)
+    print(f"json_util round-trip: {oldTime * 1000:8.3f} ms")
+    print(f"toJson:               {newTime * 1000:8.3f} ms ({oldTime / newTime:.1f}x faster)")
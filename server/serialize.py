@@ -0,0 +1,37 @@
+'''
+One-pass JSON encoding for the API responses.
+BSON types (ObjectId, datetime, ...) become the same extended JSON that
+json_util.dumps writes, so the output matches the old json_util round-trip
+followed by jsonify (sorted keys, compact). orjson is used when installed.
+'''
+
+import json
+
+from bson import json_util
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson:
+    # Datetimes go through json_util like every other BSON type instead of orjson's ISO strings
+    ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SERIALIZE_NUMPY
+
+
+def toJson(data):
+    '''
+    Encode data (which may hold BSON types) straight to JSON bytes.
+    '''
+    if orjson:
+        return orjson.dumps(data, default=json_util.default, option=ORJSON_OPTIONS)
+
+    return json.dumps(data, default=json_util.default, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def jsonResponse(data):
+    '''
+    Drop-in replacement for flask.jsonify.
+    '''
+    return Response(toJson(data), mimetype='application/json')
@@ -1,45 +1,72 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request
 from flask_cors import CORS, cross_origin
-import pymongo
+import copy
 import random
 import json
-from bson import json_util
 from bson.objectid import ObjectId
 import time
-import heapq
-import math
+
+import serverConfig
+from backends import createBackend
+from langdb.scoring import DEFAULT_REPETITION_CONSTANTS, RepScores, repDataDueTime
+from serialize import jsonResponse
+from similarity import SimilarityIndex
+from snippetCache import SnippetCache
+from ttlCache import TTLCache
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
-client = pymongo.MongoClient('mongodb://localhost:27017/')
-VOCAB_COLLECTION = client['language']['vocab']
-SNIPPETS_COLLECTION = client['language']['snippets']
-USER_SETTINGS_COLLECTION = client['language']['user_settings']
+# Mongo or SQLite, picked in serverConfig.py
+BACKEND = createBackend(serverConfig)
+
+SNIPPET_CACHE = SnippetCache(
+    BACKEND,
+    maxSize=serverConfig.SNIPPET_CACHE_SIZE,
+    prefetch=serverConfig.SNIPPET_PREFETCH,
+)
+
+# Built from the vocab vectors on the first /vocab/similar request
+SIMILARITY_INDEX = SimilarityIndex(
+    BACKEND,
+    refreshSeconds=serverConfig.SIMILARITY_REFRESH_SECONDS,
+)
+
+# How many overdue candidates per requested item are scored exactly at request time
+REP_CANDIDATE_FACTOR = 4
 
 DEFAULT_USER_SETTINGS = {
-    "repetition_constants": {
-        "S": 2670,
-        "curve_shapes": {
-            "again": 1,
-            "hard": 2,
-            "good": 4,
-            "easy": 6,
-        }
-    },
+    "repetition_constants": DEFAULT_REPETITION_CONSTANTS,
 }
 
+# User settings docs by ('id', id) and ('username', username)
+USER_CACHE = TTLCache(
+    maxSize=serverConfig.USER_CACHE_SIZE,
+    ttl=serverConfig.USER_CACHE_TTL_SECONDS,
+)
+
+def findUserCached(username=None, userId=None):
+    '''
+    BACKEND.findUser through USER_CACHE. The returned doc is shared, so don't modify it.
+    '''
+    key = ('id', str(userId)) if userId else ('username', username)
+    userDoc = USER_CACHE.get(key)
+    if userDoc is None:
+        userDoc = BACKEND.findUser(username=username, userId=userId)
+        if userDoc:
+            USER_CACHE.set(('id', str(userDoc['_id'])), userDoc)
+            USER_CACHE.set(('username', userDoc['username']), userDoc)
+
+    return userDoc
+
+def invalidateUser(userDoc):
+    USER_CACHE.delete(('id', str(userDoc['_id'])), ('username', userDoc.get('username')))
+
 def getBestVocab(N=20, num_parents=2):
     '''
     Gets the N best vocab words (common words that need practicing).
     '''
-    goodVocab = list(
-        VOCAB_COLLECTION.find({}, {'_id': 0}).sort([
-            ('rep_data.next_review', 1),
-            ('word_freq', -1)
-        ])
-        .limit(N)
-    )
+    goodVocab = BACKEND.bestVocab(N)
 
     goodParentIDs = []
     for doc in goodVocab:
@@ -49,7 +76,7 @@ def getBestVocab(N=20, num_parents=2):
         goodParentIDs.extend(parents[:num_parents])
 
     print(f"Finding snippets for {len(goodParentIDs)} parent IDs")
-    goodSnippets = list(SNIPPETS_COLLECTION.find({'id': {'$in': goodParentIDs}}, {'_id': 0}))
+    goodSnippets = BACKEND.snippetsByIds(goodParentIDs)
 
     return {
         'vocab': goodVocab,
@@ -74,9 +101,6 @@ def updateMatchingPaths(src, target, path=None):
                     target[key] = {}
                 updateMatchingPaths(value, target[key], path=currPath)
 
-def repDataCurveEquation(timeDelta, S, alpha):
-    return math.e ** (-timeDelta / (alpha * S))
-
 
 ### API ROUTES ###
 
@@ -90,12 +114,12 @@ def getSnippets():
         num_parents = int(request.args.get('num_parents', 2))
 
         if (N < 0) or (num_parents < 0):
-            return jsonify(
+            return jsonResponse(
                 {'error': 'Negative number args are not allowed.'},
             ), 400
 
         print(f"Got request for {N} snippets ({num_parents} parents each)")
-        return jsonify(
+        return jsonResponse(
             getBestVocab(N=N, num_parents=num_parents),
         ), 200
 
@@ -104,68 +128,103 @@ def getSnippets():
 def getNextSnippet():
     '''
     Get the next snippet in the specific media.
+    With `count`, returns a list of up to count upcoming snippets instead.
     NOTE: Should be the id of the snippet, not the mongo _id.
     '''
     if request.method == 'GET':
         if 'id' not in request.args:
-            return jsonify({'error': 'No id provided.'}), 400
+            return jsonResponse({'error': 'No id provided.'}), 400
         currentSnippetId = request.args.get('id')
 
-        # Query db for the current snippet
-        currentSnippet = SNIPPETS_COLLECTION.find_one({'id': currentSnippetId})
-        processed = json.loads(json_util.dumps(currentSnippet))
+        try:
+            count = int(request.args.get('count', 1))
+        except:
+            return jsonResponse({'error': 'Invalid count provided. Must be an integer.'}), 400
+
+        if count < 1 or count > serverConfig.MAX_SNIPPET_WINDOW:
+            return jsonResponse({'error': f'count must be between 1 and {serverConfig.MAX_SNIPPET_WINDOW}.'}), 400
 
-        # Get the next snippet
-        currentMediaIndex = processed['media_index']
-        currentMediaPath = processed['source_path']
+        # Look up the current snippet
+        currentSnippet = SNIPPET_CACHE.byId(currentSnippetId)
+        if not currentSnippet:
+            return jsonResponse({'error': f'No snippet found with id: {currentSnippetId}'}), 404
 
-        nextSnippetDoc = SNIPPETS_COLLECTION.find_one({
-            'media_index': currentMediaIndex + 1,
-            'source_path': currentMediaPath
-        })
+        # Get the next snippets
+        currentMediaIndex = currentSnippet['media_index']
+        currentMediaPath = currentSnippet['source_path']
+
+        nextSnippetDocs = SNIPPET_CACHE.window(currentMediaPath, currentMediaIndex + 1, count)
 
         # TODO: Add a check here to determine if there really are no more snippets from the source.
-        if not nextSnippetDoc:
-            return jsonify({'error': 'No next snippet found.'}), 404
+        if not nextSnippetDocs:
+            return jsonResponse({'error': 'No next snippet found.'}), 404
+
+        if 'count' not in request.args:
+            return jsonResponse(nextSnippetDocs[0]), 200
+
+        return jsonResponse(nextSnippetDocs), 200
+
+
+# Vocab endpoints
+
+@app.route('/vocab/similar', methods=['GET'])
+@cross_origin()
+def getSimilarVocab():
+    '''
+    The k vocab items with the closest word vectors (cosine similarity) to id.
+    '''
+    if request.method == 'GET':
+        if 'id' not in request.args:
+            return jsonResponse({'error': 'No id provided.'}), 400
+        vocabId = request.args.get('id')
 
-        processedNext = json.loads(json_util.dumps(nextSnippetDoc))
+        try:
+            k = int(request.args.get('k', 10))
+        except:
+            return jsonResponse({'error': 'Invalid k provided. Must be an integer.'}), 400
 
-        return jsonify(processedNext), 200
+        if k < 1 or k > serverConfig.MAX_SIMILAR:
+            return jsonResponse({'error': f'k must be between 1 and {serverConfig.MAX_SIMILAR}.'}), 400
+
+        similar = SIMILARITY_INDEX.similar(vocabId, k)
+        if similar is None:
+            return jsonResponse({'error': f'No vocab vector found with id: {vocabId}'}), 404
+
+        return jsonResponse({
+            'id': vocabId,
+            'similar': [{'id': similarId, 'score': score} for similarId, score in similar],
+        }), 200
 
 
 # User API endpoints
 
 def getUserDoc(userName=None, userId=None):
     if not userId and not userName:
-        return jsonify({'error': 'No username or id provided.'}), 400
+        return jsonResponse({'error': 'No username or id provided.'}), 400
 
     # Build query by username or user id
+    userBsonId = None
     if userId:
         try:
             userBsonId = ObjectId(userId)
-            query = {'_id': userBsonId}
         except:
-            return jsonify({
+            return jsonResponse({
                 'error': 'Invalid user id provided. Must be a valid monog ObjectId format.'
             }), 400
-    elif userName:
-        query = {'username': userName}
 
     # Query for user doc
     try:
-        userDoc = USER_SETTINGS_COLLECTION.find_one(query)
+        userDoc = findUserCached(username=userName, userId=userBsonId)
     except:
-        return jsonify({
+        return jsonResponse({
             'error': f'Error querying for user document with id: {userId}'
         }), 500
 
     if not userDoc:
-        return jsonify({'error': f'No user found with id: {userId}'}), 404
+        return jsonResponse({'error': f'No user found with id: {userId}'}), 404
 
     # Return result
-    return jsonify(
-        json.loads(json_util.dumps(userDoc)),
-    ), 200
+    return jsonResponse(userDoc), 200
 
 @app.route('/user', methods=['GET'])
 @cross_origin()
@@ -180,39 +239,41 @@ def getUser():
 def updateUser():
     userId = request.args.get('id')
     if not userId:
-        return jsonify({'error': 'No user id provided.'}), 400
+        return jsonResponse({'error': 'No user id provided.'}), 400
 
     try:
         userBsonId = ObjectId(userId)
     except:
-        return jsonify({
+        return jsonResponse({
             'error': 'Invalid user id provided. Must be a valid monog ObjectId format.'
         }), 400
 
     try:
-        userDoc = USER_SETTINGS_COLLECTION.find_one({'_id': userBsonId})
+        userDoc = BACKEND.findUser(userId=userBsonId)
     except:
-        return jsonify({
+        return jsonResponse({
             'error': f'Error querying for user document with id: {userId}'
         }), 500
 
     if not userDoc:
-        return jsonify({'error': f'No user found with id: {userId}'}), 404
+        return jsonResponse({'error': f'No user found with id: {userId}'}), 404
 
     # Get updated params from request body
     data = request.get_json()
     if not data:
-        return jsonify({'error': 'No data provided.'}), 400
+        return jsonResponse({'error': 'No data provided.'}), 400
     print(f'found body data: {data}')
     print(dir(request))
 
     # Recursively walk the request body and update if the old doc has a matching key
+    invalidateUser(userDoc)
     updateMatchingPaths(data, userDoc)
 
     # Update the user document
-    result = USER_SETTINGS_COLLECTION.update_one({'_id': userBsonId}, {'$set': userDoc}).raw_result
+    result = BACKEND.updateUser(userBsonId, userDoc)
+    invalidateUser(userDoc)
 
-    return jsonify({
+    return jsonResponse({
         'result': result,
     }), 200
 
@@ -221,104 +282,138 @@ def updateUser():
 def postUser():
     username = request.args.get('username')
     if not username:
-        return jsonify({'error': 'No username provided. (required query param)'}), 400
+        return jsonResponse({'error': 'No username provided. (required query param)'}), 400
 
     # Check that username isn't taken
-    existingUser = USER_SETTINGS_COLLECTION.find_one({'username': username})
+    existingUser = BACKEND.findUser(username=username)
     if existingUser:
-        return jsonify({'error': f'Username already taken: {username}'}), 400
+        return jsonResponse({'error': f'Username already taken: {username}'}), 400
 
-    # Create new user
-    newUser = DEFAULT_USER_SETTINGS
+    # Create new user (from a copy, inserting sets _id on the doc)
+    newUser = copy.deepcopy(DEFAULT_USER_SETTINGS)
     newUser['username'] = username
 
     # Insert new user
-    result = USER_SETTINGS_COLLECTION.insert_one(newUser)
+    newUserId = BACKEND.insertUser(newUser)
+    USER_CACHE.delete(('id', newUserId), ('username', username))
 
-    return jsonify({
-        'id': str(result.inserted_id),
+    return jsonResponse({
+        'id': newUserId,
     }), 200
 
 
 # Spaced rep data endpoints
 
-def updateVocabItem(vocabId, strength, reviewTime, userDiffs):
+def updateVocabItems(userId, vocabIds, strength, reviewTime, userDiffs, userS):
+    '''
+    Log the user's review of every vocab id: one batched read of their review
+    state, then the state upserts and the appended log entries.
+    Returns a status per id: 200 updated, 204 not in the db, 422 failed.
+    '''
+    statuses = {}
     try:
-        vocabDoc = VOCAB_COLLECTION.find_one({'id': vocabId})
-
-        if not vocabDoc:
-            return 204
-
-        # Update the vocab item
-        repData = vocabDoc['rep_data']
-        newData = repData.copy()
-        strengthValue = userDiffs[strength]
-        if repData['history_length'] == 0:
-            # First exposure. Set everything to defaults.
-            newData['last_review'] = reviewTime
-            newData['last_strength'] = strength
-            newData['average_strength'] = strengthValue
-            newData['history_length'] = 1
-            newData['history'] = [
-                {
-                    'strength': strength,
-                    'time': reviewTime,
-                }
-            ]
-        else:
-            # Compute new values
-            newData['last_review'] = reviewTime
-            newData['last_strength'] = strength
-            newData['average_strength'] = (
-                (repData['average_strength'] * repData['history_length']) + strengthValue
-            ) / (repData['history_length'] + 1)
-            newData['history_length'] += 1
-            newData['history'].append({
-                'strength': strength,
-                'time': reviewTime,
-            })
-
-        # Update the doc
-        result = VOCAB_COLLECTION.update_one({'id': vocabId}, {'$set': {'rep_data': newData}})
-
-        # return result.modified_count == 1
-        return 200
+        repStates = BACKEND.repStates(userId, vocabIds)
     except Exception as e:
-        print(f'Error updating vocab item: {vocabId}')
+        print(f'Error fetching vocab items: {vocabIds}')
         print(e)
-        return 422
+        return [422 for vId in vocabIds]
+
+    # Count repeats so an id listed twice is logged twice, as before
+    reviewCounts = {}
+    for vId in vocabIds:
+        reviewCounts[vId] = reviewCounts.get(vId, 0) + 1
+
+    reviews = []
+    for vId, count in reviewCounts.items():
+        if vId not in repStates:
+            statuses[vId] = 204
+            continue
+
+        try:
+            repState = repStates[vId]
+            strengthValue = userDiffs[strength]
+            historyLength = repState['history_length']
+            averageStrength = repState['average_strength']
+            for _ in range(count):
+                averageStrength = (
+                    (averageStrength * historyLength) + strengthValue
+                ) / (historyLength + 1)
+                historyLength += 1
+
+            reviews.append({
+                'id': vId,
+                'word_freq': repState['word_freq'],
+                'set': {
+                    'last_review': reviewTime,
+                    'last_strength': strength,
+                    'average_strength': averageStrength,
+                    # Precompute when each rank type considers the item due again
+                    'next_review': repDataDueTime(reviewTime, userS, strengthValue),
+                    'next_review_average': repDataDueTime(reviewTime, userS, averageStrength),
+                },
+                'history': [
+                    {
+                        'strength': strength,
+                        'time': reviewTime,
+                    }
+                ] * count,
+            })
+        except Exception as e:
+            print(f'Error updating vocab item: {vId}')
+            print(e)
+            statuses[vId] = 422
+
+    if reviews:
+        updateIds = [review['id'] for review in reviews]
+        for vId in updateIds:
+            statuses[vId] = 200
+        try:
+            errors = BACKEND.logReviews(userId, reviews)
+            for vId, message in errors.items():
+                print(f'Error updating vocab item: {vId}')
+                print(message)
+                statuses[vId] = 422
+        except Exception as e:
+            print(f'Error writing vocab items: {updateIds}')
+            print(e)
+            for vId in updateIds:
+                statuses[vId] = 422
+
+    return [statuses[vId] for vId in vocabIds]
 
 @app.route('/rep', methods=['POST'])
 @cross_origin()
 def logVocabLearning():
     username = request.args.get('username')
     if not username:
-        return jsonify({'error': 'No username provided. (required query param)'}), 400
+        return jsonResponse({'error': 'No username provided. (required query param)'}), 400
 
-    userSettings = USER_SETTINGS_COLLECTION.find_one({'username': username})
+    userSettings = findUserCached(username=username)
     if not userSettings:
-        return jsonify({'error': f'Cannot update vocab. No user found with username: {username}'}), 404
+        return jsonResponse({'error': f'Cannot update vocab. No user found with username: {username}'}), 404
 
     data = request.get_json()
     if not data:
-        return jsonify({'error': 'No data provided.'}), 400
+        return jsonResponse({'error': 'No data provided.'}), 400
 
     # Get difficulty for user
-    userSettings = USER_SETTINGS_COLLECTION.find_one({'username': username})
     print(f'Found user settings doc: {userSettings}')
 
     userDiffs = userSettings['repetition_constants']['curve_shapes']
+    userS = userSettings['repetition_constants']['S']
 
     print(f'found body data: {json.dumps(data, indent=2)}');
     codes = set()
     updateStatuses = []
-    for vId in data['vocab']:
-        updateResult = updateVocabItem(
-            vId,
-            strength=data['strength'],
-            reviewTime=data['review_time'],
-            userDiffs=userDiffs,
-        )
+    updateResults = updateVocabItems(
+        str(userSettings['_id']),
+        data['vocab'],
+        strength=data['strength'],
+        reviewTime=data['review_time'],
+        userDiffs=userDiffs,
+        userS=userS,
+    )
+    for vId, updateResult in zip(data['vocab'], updateResults):
         message = ''
         if updateResult == 200:
             message = 'Successfully updated vocab item'
@@ -338,14 +433,14 @@ def logVocabLearning():
     # Full success/fail/missing
     if len(codes) == 1:
         if 200 in codes:
-            return jsonify({'success': True}), 200
+            return jsonResponse({'success': True}), 200
         elif 204 in codes:
-            return jsonify({
+            return jsonResponse({
                 'success': True,
                 'message': 'All provoided vocab items were not in the db\'s vocab set',
             }), 204
         elif 422 in codes:
-            return jsonify({'error': 'Failed to update any vocab items.'}), 422
+            return jsonResponse({'error': 'Failed to update any vocab items.'}), 422
 
     # Mixed results
     mixedResponse = {
@@ -353,7 +448,7 @@ def logVocabLearning():
         'results': updateStatuses,
         'strength': data['strength'],
     }
-    return jsonify(mixedResponse), 207
+    return jsonResponse(mixedResponse), 207
 
 @app.route('/rep', methods=['GET'])
 @cross_origin()
@@ -361,80 +456,56 @@ def getRepItems():
     DEFAULT_N = 10
     username = request.args.get('username')
     if not username:
-        return jsonify({'error': 'No username provided. (required query param)'}), 400
+        return jsonResponse({'error': 'No username provided. (required query param)'}), 400
 
     rankTypes = ['recent', 'average']
     rankType = request.args.get('rank_type', 'recent')
     if rankType not in rankTypes:
-        return jsonify({'error': f'Invalid rank type. Must be one of: {rankTypes} (defaults to recent)'}), 400
+        return jsonResponse({'error': f'Invalid rank type. Must be one of: {rankTypes} (defaults to recent)'}), 400
 
     try:
         N = int(request.args.get('N', DEFAULT_N))
     except:
-        return jsonify({'error': 'Invalid N provided. Must be an integer.'}), 400
+        return jsonResponse({'error': 'Invalid N provided. Must be an integer.'}), 400
+
+    if N < 0:
+        return jsonResponse({'error': 'Negative number args are not allowed.'}), 400
 
     currTime = time.time()
 
-    userSettings = USER_SETTINGS_COLLECTION.find_one({'username': username})
+    userSettings = findUserCached(username=username)
     if not userSettings:
-        return jsonify({'error': f'Cannot get vocab. No user found with username: {username}'}), 404
+        return jsonResponse({'error': f'Cannot get vocab. No user found with username: {username}'}), 404
 
     userS = userSettings['repetition_constants']['S']
     userDiffs = userSettings['repetition_constants']['curve_shapes']
 
-    # Get all the seen vocab items
-    query = {
-        'rep_data.last_review': {'$ne': None}
-    }
-    documents = VOCAB_COLLECTION.find(query)
-    # count = VOCAB_COLLECTION.count_documents(query)
-
-    # Compute the rank values
-    heap = []
-    for doc in documents:
-        repData = doc['rep_data']
-        timeDelta = currTime - repData['last_review']
-
-        if rankType == 'recent':
-            lastStrength = repData['last_strength']
-            alpha = userDiffs[lastStrength]
-            rankValue = repDataCurveEquation(timeDelta, userS, alpha)
-        elif rankType == 'average':
-            historyValues = [userDiffs[item['strength']] for item in repData['history']]
-            avgAlpha = sum(historyValues) / len(historyValues)
-            rankValue = repDataCurveEquation(timeDelta, userS, avgAlpha)
-
-        item = doc['id']
-        if len(heap) < N:
-            heapq.heappush(heap, (-rankValue, item))
-        else:
-            heapq.heappushpop(heap, (-rankValue, item))
+    # Get the vocab items this user reviewed that are furthest past their due time
+    documents = BACKEND.dueVocab(str(userSettings['_id']), rankType, N * REP_CANDIDATE_FACTOR)
+
+    # Rank the candidates by their current retention
+    scores = RepScores.fromDocs(documents, userDiffs)
+    rankedVocab = scores.lowest(N, currTime, userS, rankType=rankType)
 
     try:
-        # Choose a random parent for each vocab item
+        # Choose a random parent for each vocab item, skipping snippets already chosen
+        parentsById = {doc['id']: doc['parents'] for doc in documents}
         snippetSet = set()
-        for (rank, vId) in heap:
-            vocabDoc = VOCAB_COLLECTION.find_one({'id': vId})
-            parents = vocabDoc['parents']
-            random.shuffle(parents)
-            while parents and parents[0] in snippetSet:
-                parents.pop(0)
+        for (rank, vId) in rankedVocab:
+            parents = [parent for parent in parentsById[vId] if parent not in snippetSet]
             if parents:
-                snippetSet.add(parents[0])
+                snippetSet.add(random.choice(parents))
 
         # Get the snippets
-        snippets = list(SNIPPETS_COLLECTION.find(
-            { 'id': {'$in': list(snippetSet)} },
-            { '_id': 0 }
-        ))
+        snippets = BACKEND.snippetsByIds(snippetSet)
 
-        return jsonify({
+        return jsonResponse({
             'status': 'success',
-            'vocab': heap,
+            'vocab': rankedVocab,
             'snippets': snippets,
         }), 200
     except Exception as e:
-        return jsonify({
+        return jsonResponse({
             'error': f'Failed to get snippets.',
             'exception': str(e),
         }), 500
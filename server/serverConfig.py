@@ -0,0 +1,50 @@
+'''
+Settings for the API server. Each one can be overridden with an environment variable.
+'''
+
+import os
+
+from langdb.migrations import SQLITE_DEFAULT_PATH
+
+# Which backend in backends.py serves the routes: 'mongo' or 'sqlite'
+DB_BACKEND = os.environ.get('LANGUAGE_DB_BACKEND', 'mongo')
+
+MONGO_URI = os.environ.get('LANGUAGE_MONGO_URI', 'mongodb://localhost:27017/')
+MONGO_DB = os.environ.get('LANGUAGE_MONGO_DB', 'language')
+
+# Shared with the ingestion SqliteInterface default
+SQLITE_PATH = os.environ.get('LANGUAGE_SQLITE_PATH', SQLITE_DEFAULT_PATH)
+
+# Connections per server process. gunicorn runs one process per worker,
+# so the database sees up to workers * DB_POOL_SIZE connections.
+DB_POOL_SIZE = int(os.environ.get('LANGUAGE_DB_POOL_SIZE', 10))
+DB_MIN_POOL_SIZE = int(os.environ.get('LANGUAGE_DB_MIN_POOL_SIZE', 0))
+
+# Timeouts in milliseconds
+DB_CONNECT_TIMEOUT_MS = int(os.environ.get('LANGUAGE_DB_CONNECT_TIMEOUT_MS', 5_000))
+DB_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('LANGUAGE_DB_SERVER_SELECTION_TIMEOUT_MS', 5_000))
+# Longest a single query may run (for SQLite: wait on a write lock)
+DB_QUERY_TIMEOUT_MS = int(os.environ.get('LANGUAGE_DB_QUERY_TIMEOUT_MS', 10_000))
+# Longest a request waits for a free pooled connection
+DB_POOL_WAIT_TIMEOUT_MS = int(os.environ.get('LANGUAGE_DB_POOL_WAIT_TIMEOUT_MS', 2_000))
+
+# Where the vocab and snippet reads go: primary, primaryPreferred, secondary,
+# secondaryPreferred or nearest. User settings and all writes stay on the primary.
+MONGO_READ_PREFERENCE = os.environ.get('LANGUAGE_MONGO_READ_PREFERENCE', 'primary')
+
+# User settings are cached per process and re-read after this many seconds
+# (writes through this process invalidate them right away)
+USER_CACHE_SIZE = int(os.environ.get('LANGUAGE_USER_CACHE_SIZE', 1024))
+USER_CACHE_TTL_SECONDS = float(os.environ.get('LANGUAGE_USER_CACHE_TTL_SECONDS', 60))
+
+# Snippet docs cached by (source_path, media_index) for /next_media_snippet.
+# A miss loads this many upcoming snippets of the same source in one query.
+SNIPPET_CACHE_SIZE = int(os.environ.get('LANGUAGE_SNIPPET_CACHE_SIZE', 10_000))
+SNIPPET_PREFETCH = int(os.environ.get('LANGUAGE_SNIPPET_PREFETCH', 20))
+# Most snippets one /next_media_snippet call may ask for with `count`
+MAX_SNIPPET_WINDOW = int(os.environ.get('LANGUAGE_MAX_SNIPPET_WINDOW', 50))
+
+# GET /vocab/similar: vocab added by an ingest run is picked up at most this many
+# seconds later, and k may be at most MAX_SIMILAR
+SIMILARITY_REFRESH_SECONDS = float(os.environ.get('LANGUAGE_SIMILARITY_REFRESH_SECONDS', 60))
+MAX_SIMILAR = int(os.environ.get('LANGUAGE_MAX_SIMILAR', 100))
@@ -0,0 +1,119 @@
+'''
+Nearest neighbours over the vocab vectors for GET /vocab/similar.
+Vectors are kept as unit float32 rows of one matrix, so cosine similarity is a
+matmul. It is done in blocks of rows, each followed by an argpartition for the top k.
+The index is built on first use and then picks up vocab added since the last
+refresh (by a backend watermark), at most once every refreshSeconds.
+'''
+
+import threading
+import time
+
+import numpy as np
+
+from langdb.vectors import unpackVector
+
+
+class SimilarityIndex:
+    def __init__(self, backend, blockSize=32_768, refreshSeconds=60):
+        self.backend = backend
+        self.blockSize = blockSize
+        self.refreshSeconds = refreshSeconds
+        self.lock = threading.Lock()
+
+        self.ids = []
+        self.positions = {}
+        self.matrix = None
+        self.size = 0
+        self.watermark = None
+        self.lastRefresh = None
+
+    def __len__(self):
+        return self.size
+
+    def add(self, ids, vectors):
+        '''
+        Add (or replace) unit rows for ids. The matrix grows by doubling.
+        '''
+        if not ids:
+            return
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+        if self.matrix is None:
+            self.matrix = np.empty((max(len(ids), 1024), vectors.shape[1]), dtype=np.float32)
+
+        for vocabId, vector in zip(ids, vectors):
+            position = self.positions.get(vocabId)
+            if position is None:
+                if self.size == len(self.matrix):
+                    grown = np.empty((2 * len(self.matrix), self.matrix.shape[1]), dtype=np.float32)
+                    grown[:self.size] = self.matrix[:self.size]
+                    self.matrix = grown
+                position = self.size
+                self.positions[vocabId] = position
+                self.ids.append(vocabId)
+                self.size += 1
+            self.matrix[position] = vector
+
+    def refresh(self, force=False):
+        '''
+        Load the vectors stored since the last refresh. Returns how many were added.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.lastRefresh is not None and now - self.lastRefresh < self.refreshSeconds:
+                return 0
+
+            rows, self.watermark = self.backend.vocabVectors(after=self.watermark)
+            self.lastRefresh = now
+
+            if not rows:
+                return 0
+
+            vectors = [(vocabId, unpackVector(blob)) for vocabId, blob in rows]
+
+            # Drop vectors of another dimension (e.g. from a different spacy model)
+            dim = self.matrix.shape[1] if self.matrix is not None else len(vectors[0][1])
+            vectors = [(vocabId, vector) for vocabId, vector in vectors if len(vector) == dim]
+
+            self.add([vocabId for vocabId, _ in vectors], [vector for _, vector in vectors])
+            print(f"Similarity index: added {len(vectors)} vectors ({self.size} total)")
+            return len(vectors)
+
+    def similar(self, vocabId, k=10):
+        '''
+        The k most similar vocab ids to vocabId as [(id, cosine similarity)],
+        or None if vocabId has no vector.
+        '''
+        self.refresh()
+
+        with self.lock:
+            position = self.positions.get(vocabId)
+            if position is None:
+                return None
+
+            query = self.matrix[position]
+            bestIds = np.empty(0, dtype=np.int64)
+            bestScores = np.empty(0, dtype=np.float32)
+            for start in range(0, self.size, self.blockSize):
+                scores = self.matrix[start:min(start + self.blockSize, self.size)] @ query
+                rows = np.arange(start, start + len(scores))
+
+                # Keep the top k of this block and the running top k
+                keep = min(k + 1, len(scores))
+                top = np.argpartition(-scores, keep - 1)[:keep]
+                bestIds = np.concatenate([bestIds, rows[top]])
+                bestScores = np.concatenate([bestScores, scores[top]])
+                if len(bestScores) > k + 1:
+                    top = np.argpartition(-bestScores, k)[:k + 1]
+                    bestIds, bestScores = bestIds[top], bestScores[top]
+
+            order = np.argsort(-bestScores, kind='stable')
+            return [
+                (self.ids[row], float(score))
+                for row, score in zip(bestIds[order], bestScores[order])
+                if row != position
+            ][:k]
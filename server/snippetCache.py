@@ -0,0 +1,88 @@
+'''
+In-process LRU of snippet docs for reading a source in order (/next_media_snippet).
+Docs are keyed by (source_path, media_index), with an id -> position map for
+looking up the current snippet. A miss loads the upcoming snippets of the same
+source in one range query, so the next clicks are answered from memory.
+Snippets do not change once ingested, so entries never expire.
+'''
+
+import threading
+from collections import OrderedDict
+
+
+class SnippetCache:
+    def __init__(self, backend, maxSize=10_000, prefetch=20):
+        self.backend = backend
+        self.maxSize = maxSize
+        self.prefetch = prefetch
+        self.docs = OrderedDict()
+        self.positions = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, docs):
+        with self.lock:
+            for doc in docs:
+                position = (doc['source_path'], doc['media_index'])
+                self.docs[position] = doc
+                self.docs.move_to_end(position)
+                self.positions[doc['id']] = position
+
+            while len(self.docs) > self.maxSize:
+                _, evicted = self.docs.popitem(last=False)
+                self.positions.pop(evicted['id'], None)
+
+    def cached(self, position):
+        with self.lock:
+            doc = self.docs.get(position)
+            if doc is not None:
+                self.docs.move_to_end(position)
+            return doc
+
+    def byId(self, snippetId):
+        with self.lock:
+            position = self.positions.get(snippetId)
+        doc = self.cached(position) if position else None
+        if doc is not None:
+            self.hits += 1
+            return doc
+
+        self.misses += 1
+        doc = self.backend.snippetById(snippetId)
+        if doc:
+            self.add([doc])
+        return doc
+
+    def window(self, sourcePath, startIndex, count):
+        '''
+        Up to count snippets of the source from startIndex on, stopping at the first gap.
+        '''
+        docs = []
+        for mediaIndex in range(startIndex, startIndex + count):
+            doc = self.cached((sourcePath, mediaIndex))
+            if doc is None:
+                break
+            docs.append(doc)
+
+        if len(docs) == count:
+            self.hits += 1
+            return docs
+
+        # Load the rest of the window plus the prefetch in one range query
+        self.misses += 1
+        missingStart = startIndex + len(docs)
+        fetched = self.backend.snippetRange(
+            sourcePath,
+            missingStart,
+            max(count - len(docs), self.prefetch),
+        )
+        self.add(fetched)
+
+        byIndex = {doc['media_index']: doc for doc in fetched}
+        for mediaIndex in range(missingStart, startIndex + count):
+            if mediaIndex not in byIndex:
+                break
+            docs.append(byIndex[mediaIndex])
+
+        return docs
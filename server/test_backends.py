@@ -0,0 +1,110 @@
+'''
+Explain the indexed read queries of both backends and fail if any of them falls
+back to a full scan or an in-memory sort.
+Mongo plans fail on COLLSCAN or SORT stages, SQLite plans on a table SCAN
+without an index or a TEMP B-TREE sort.
+The SQLite cases run on a temp file. The Mongo cases run on a scratch database
+of LANGUAGE_MONGO_URI, and are skipped when no server answers there.
+Run from the repo root with: python -m pytest
+'''
+
+import pymongo
+import pymongo.errors
+import pytest
+
+import serverConfig
+from backends import MongoBackend, SqliteBackend
+
+BAD_STAGES = {'COLLSCAN', 'SORT'}
+MONGO_TEST_DB = 'language_query_plans_test'
+
+MONGO_QUERIES = {
+    'GET /snippets best vocab': lambda backend: backend.bestVocabCursor(20),
+    'GET /rep recent': lambda backend: backend.dueStateCursor('a', 'recent', 40),
+    'GET /rep average': lambda backend: backend.dueStateCursor('a', 'average', 40),
+    'GET /rep parents and POST /rep unseen vocab': lambda backend: backend.vocabCollection.find({'id': {'$in': ['a - NOUN']}}),
+    'POST /rep state fetch': lambda backend: backend.repStateCollection.find({
+        'user_id': 'a',
+        'vocab_id': {'$in': ['a - NOUN']},
+    }),
+    'POST /rep queue key upsert': lambda backend: backend.vocabDueCollection.find({'id': 'a - NOUN'}),
+    'snippets by id': lambda backend: backend.snippetsCollection.find({'id': {'$in': ['a']}}),
+    'GET /next_media_snippet next snippet': lambda backend: backend.snippetsCollection.find({
+        'media_index': 1,
+        'source_path': 'a.pdf',
+    }),
+    'GET /next_media_snippet prefetch': lambda backend: backend.snippetRangeCursor('a.pdf', 1, 20),
+    'user settings by username': lambda backend: backend.userSettingsCollection.find({'username': 'a'}),
+}
+
+SQLITE_QUERIES = {
+    'GET /snippets best vocab': (SqliteBackend.BEST_VOCAB_SQL, (20,)),
+    'GET /rep recent': (SqliteBackend.DUE_STATE_SQL.format(due='next_review'), ('a', 40)),
+    'GET /rep average': (SqliteBackend.DUE_STATE_SQL.format(due='next_review_average'), ('a', 40)),
+    'GET /rep parents and POST /rep unseen vocab': ('SELECT id, word_freq FROM vocab WHERE id IN (?)', ('a - NOUN',)),
+    'POST /rep state fetch': (
+        'SELECT vocab_id FROM rep_state WHERE user_id = ? AND vocab_id IN (?)',
+        ('a', 'a - NOUN'),
+    ),
+    'POST /rep queue key upsert': ('SELECT next_review FROM vocab_due WHERE id = ?', ('a - NOUN',)),
+    'snippets by id': ('SELECT doc FROM snippets WHERE id IN (?)', ('a',)),
+    'GET /next_media_snippet next snippet': (SqliteBackend.SNIPPET_AT_SQL, ('a.pdf', 1)),
+    'GET /next_media_snippet prefetch': (SqliteBackend.SNIPPET_RANGE_SQL, ('a.pdf', 1, 21)),
+    'user settings by username': ('SELECT id, doc FROM user_settings WHERE username = ?', ('a',)),
+}
+
+def planStages(plan):
+    '''
+    Collect every stage name in an explain plan, however deeply it is nested.
+    '''
+    stages = set()
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.add(plan['stage'])
+        for value in plan.values():
+            stages |= planStages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages |= planStages(value)
+
+    return stages
+
+def badSqliteSteps(steps):
+    return {
+        step for step in steps
+        if 'TEMP B-TREE' in step or (step.startswith('SCAN') and 'USING' not in step)
+    }
+
+
+@pytest.fixture(scope='module')
+def mongoBackend():
+    client = pymongo.MongoClient(serverConfig.MONGO_URI, serverSelectionTimeoutMS=1_000)
+    try:
+        client.admin.command('ping')
+    except pymongo.errors.PyMongoError:
+        pytest.skip(f'No MongoDB server at {serverConfig.MONGO_URI}')
+
+    # The backend declares the indexes on the scratch database, like on the real one
+    backend = MongoBackend(serverConfig.MONGO_URI, MONGO_TEST_DB)
+    yield backend
+    client.drop_database(MONGO_TEST_DB)
+    client.close()
+
+@pytest.fixture(scope='module')
+def sqliteBackend(tmp_path_factory):
+    return SqliteBackend(str(tmp_path_factory.mktemp('plans') / 'language.sqlite'))
+
+
+@pytest.mark.parametrize('name', MONGO_QUERIES)
+def test_mongo_query_uses_an_index(mongoBackend, name):
+    explain = MONGO_QUERIES[name](mongoBackend).explain()
+    stages = planStages(explain['queryPlanner']['winningPlan'])
+
+    assert not stages & BAD_STAGES, f"{name} -> {sorted(stages)}"
+
+@pytest.mark.parametrize('name', SQLITE_QUERIES)
+def test_sqlite_query_uses_an_index(sqliteBackend, name):
+    sql, params = SQLITE_QUERIES[name]
+    steps = [row[-1] for row in sqliteBackend.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+    assert not badSqliteSteps(steps), f"{name} -> {steps}"
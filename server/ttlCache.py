@@ -0,0 +1,47 @@
+'''
+Bounded in-process cache whose entries expire a fixed time after they are set.
+Each server process has its own, so the TTL bounds how stale another process can be.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, maxSize=1024, ttl=60):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.items[key]
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.items.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()